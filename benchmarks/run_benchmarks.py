@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import numpy as np
+from pathlib import Path
+from functools import partial
+from statistics import median
+from typing import Callable, Dict, List, Optional, Tuple
+
+from benchmarks.synthetic_data import PRESETS, generate_dataset
+from src.utils.data import GroupedExpressions, grouped_expressions_to_df, load_grouped_expressions
+from src.utils.memory_management import MB, track_memory
+from src.utils.sampling import get_subsample_matrix
+from src.utils.statistics_utils import calculate_batch_statistics, calculate_h0_statistics, calculate_std_gene_id_optimized
+from src.preprocessing import transform_data, create_meta_donor_csv, transform_data_json
+from src.utils.logger import get_logger
+
+# Set up logger
+logger = get_logger(__name__)
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+# Relative slowdown (or peak RSS growth) over the baseline reported as a regression
+DEFAULT_TOLERANCE = 0.2
+# Sample sizes of the statistics sweep benchmarks
+SWEEP_SAMPLE_SIZES = [2, 4, 8, 16]
+
+
+def measure(name: str, run: Callable[[], None], work: float, unit: str, repeats: int,
+            before_each: Optional[Callable[[], None]] = None) -> Dict:
+    """
+        Runs a benchmark repeats times and returns its median wall time, throughput (work units per second)
+        and the peak RSS (and its growth during the benchmark) over the runs
+    """
+    wall_times, peak_rss, rss_growth = [], 0, 0
+    for _ in range(repeats):
+        if before_each is not None:
+            before_each()
+        with track_memory(name) as memory:
+            start = time.perf_counter()
+            run()
+            wall_times.append(time.perf_counter() - start)
+        peak_rss = max(peak_rss, memory.peak_rss)
+        rss_growth = max(rss_growth, memory.peak_rss - memory.start_rss)
+    wall_time = median(wall_times)
+    return {"wall_time_s": wall_time, "throughput": work / wall_time if wall_time else float("inf"),
+            "throughput_unit": unit, "peak_rss_mb": peak_rss / MB, "rss_growth_mb": rss_growth / MB, "repeats": repeats}
+
+
+def run_preprocessing_benchmarks(donor_ids: List[int], n_values: int, repeats: int) -> Dict[str, Dict]:
+    """
+        Benchmarks the preprocessing stages on the donors of the current directory, without their stage cache
+    """
+    cache_path = transform_data.PROCESSED_DATA_PATH / ".stage_cache"
+    clear_cache = lambda: shutil.rmtree(cache_path, ignore_errors=True)
+    donor_dirs = transform_data.get_donor_dirs()
+
+    results = {}
+    results["transform_data"] = measure("transform_data", lambda: [transform_data.transform_donor(d) for d in donor_dirs],
+                                        n_values, "values/s", repeats, clear_cache)
+    results["create_meta_donor_csv"] = measure("create_meta_donor_csv",
+                                               lambda: create_meta_donor_csv.create_meta_donor(donor_ids),
+                                               n_values, "values/s", repeats, clear_cache)
+
+    def create_json():
+        for donor in donor_ids:
+            transform_data_json.create_donor_json(donor)
+        transform_data_json.create_meta_donor_json()
+
+    meta_values = len(load_grouped_expressions(transform_data.PROCESSED_DONORS_GE_PATH / "meta_donor").values)
+    results["transform_data_json"] = measure("transform_data_json", create_json, n_values + meta_values, "values/s",
+                                             repeats, clear_cache)
+    return results
+
+
+def get_sweep_inputs(store: GroupedExpressions, sample_size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        Samples matrix and keys of the pairs with at least sample_size samples
+    """
+    samples, sizes = get_subsample_matrix(store, sample_size)
+    kept = sizes == sample_size
+    return samples[kept], np.asarray(store.brain_region)[kept], np.asarray(store.gene_id)[kept]
+
+
+def run_statistics_benchmarks(meta_donor: GroupedExpressions, repeats: int, B: int) -> Dict[str, Dict]:
+    """
+        Benchmarks the H0 statistics and the statistics sweep on the meta donor
+    """
+    n_values = len(meta_donor.values)
+    results = {}
+    results["h0_statistics_store"] = measure("h0_statistics_store", lambda: calculate_h0_statistics(meta_donor),
+                                             n_values, "values/s", repeats)
+    # The frame is bound to the benchmark, it is released once the benchmark is done
+    results["h0_statistics_df"] = measure("h0_statistics_df",
+                                          partial(calculate_std_gene_id_optimized, grouped_expressions_to_df(meta_donor)),
+                                          n_values, "values/s", repeats)
+
+    geneid_H0 = calculate_h0_statistics(meta_donor)
+    results["subsample"] = measure("subsample", lambda: get_subsample_matrix(meta_donor, max(SWEEP_SAMPLE_SIZES)),
+                                   len(meta_donor), "pairs/s", repeats)
+    samples, brain_regions, gene_ids = get_sweep_inputs(meta_donor, max(SWEEP_SAMPLE_SIZES))
+    for method in ["wilcoxon", "bootstrap", "sequential_bootstrap"]:
+        results[f"sweep_{method}"] = measure(
+            f"sweep_{method}",
+            lambda method=method: calculate_batch_statistics(samples, brain_regions, gene_ids, geneid_H0, SWEEP_SAMPLE_SIZES,
+                                               p_value_method=method, B=B),
+            len(samples) * len(SWEEP_SAMPLE_SIZES), "pair sample sizes/s", repeats)
+    return results
+
+
+def compare_to_baseline(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """
+        Logs the ratios of the results to the baseline and returns the regressed benchmarks
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        time_ratio = result["wall_time_s"] / baseline[name]["wall_time_s"]
+        rss_ratio = result["peak_rss_mb"] / baseline[name]["peak_rss_mb"]
+        regressed = time_ratio > 1 + tolerance or rss_ratio > 1 + tolerance
+        logger.info(f"{name:28s} time x{time_ratio:.2f}  peak RSS x{rss_ratio:.2f}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def run_benchmarks(preset: str, repeats: int = 3, B: int = 1000, workdir: Optional[Path] = None,
+                   seed: int = 0) -> Dict:
+    """
+        Generates a synthetic dataset of the preset shape and runs every benchmark on it
+    """
+    shape = PRESETS[preset]
+    temporary = workdir is None
+    workdir = Path(workdir or tempfile.mkdtemp(prefix="gene_expression_benchmarks_")).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    cwd = os.getcwd()
+    # The configured data paths are relative, running in the workdir keeps the benchmark data out of the project
+    os.chdir(workdir)
+    try:
+        logger.info(f"Generating the {preset} dataset in {workdir}: {shape}")
+        shutil.rmtree(transform_data.PROCESSED_DATA_PATH, ignore_errors=True)
+        donor_ids = generate_dataset(transform_data.RAW_DATA_PATH, seed=seed, **shape)
+        n_values = shape["n_donors"] * shape["n_probes"] * shape["n_samples"]
+
+        results = run_preprocessing_benchmarks(donor_ids, n_values, repeats)
+        meta_donor = load_grouped_expressions(transform_data.PROCESSED_DONORS_GE_PATH / "meta_donor", mmap=False)
+        results.update(run_statistics_benchmarks(meta_donor, repeats, B))
+    finally:
+        os.chdir(cwd)
+        if temporary:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {"preset": preset, "shape": shape, "B": B, "python": platform.python_version(),
+            "machine": platform.machine(), "cpu_count": os.cpu_count(), "benchmarks": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the preprocessing and statistics hot paths on synthetic data")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--B", type=int, default=1000, help="bootstrap resamples of the sweep benchmarks")
+    parser.add_argument("--workdir", type=Path, help="directory of the synthetic data, a temporary one by default")
+    parser.add_argument("--output", type=Path, help="json file of the results")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--verbose", action="store_true", help="keep the logs of the benchmarked stages")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        for name in list(logging.root.manager.loggerDict):
+            if name.startswith("src."):
+                logging.getLogger(name).setLevel(logging.WARNING)
+
+    report = run_benchmarks(args.preset, args.repeats, args.B, args.workdir)
+    for name, result in report["benchmarks"].items():
+        logger.info(f"{name:28s} {result['wall_time_s']:9.3f}s  {result['throughput']:14.1f} {result['throughput_unit']:20s}"
+                    f"  peak RSS {result['peak_rss_mb']:8.1f} MB (+{result['rss_growth_mb']:.1f} MB)")
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=4))
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=4))
+        logger.info(f"Saved the baseline to {args.baseline}")
+        return
+
+    if not args.baseline.exists():
+        logger.info(f"No baseline at {args.baseline}, store one with --save-baseline")
+        return
+    baseline = json.loads(args.baseline.read_text())
+    if baseline["preset"] != report["preset"] or baseline["B"] != report["B"]:
+        logger.info(f"Baseline of preset {baseline['preset']} (B={baseline['B']}) is not comparable")
+        return
+    regressions = compare_to_baseline(report["benchmarks"], baseline["benchmarks"], args.tolerance)
+    if regressions:
+        raise SystemExit(f"Regressions over {args.tolerance:.0%} of the baseline: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List
+
+# Donor ids of the Allen Human Brain Atlas release, further synthetic donors count up from the last one
+ALLEN_DONOR_IDS = [9861, 10021, 12876, 14380, 15496, 15697]
+
+# Dataset shapes: probes and samples per donor, genes and brain structures shared by the donors
+PRESETS: Dict[str, Dict[str, int]] = {
+    "small": {"n_donors": 3, "n_probes": 2000, "n_samples": 200, "n_genes": 600, "n_structures": 60},
+    "medium": {"n_donors": 6, "n_probes": 10000, "n_samples": 500, "n_genes": 3000, "n_structures": 200},
+    # Full size of the Allen microarray release
+    "allen": {"n_donors": 6, "n_probes": 58692, "n_samples": 900, "n_genes": 20737, "n_structures": 400},
+}
+
+# Rows of MicroarrayExpression.csv written at once
+WRITE_CHUNK_ROWS = 2000
+
+
+def get_donor_ids(n_donors: int) -> List[int]:
+    """
+        Ids of n_donors donors, the Allen ids first
+    """
+    return (ALLEN_DONOR_IDS + list(range(ALLEN_DONOR_IDS[-1] + 1, ALLEN_DONOR_IDS[-1] + 1 + n_donors)))[:n_donors]
+
+
+def generate_sample_annotations(n_samples: int, structure_ids: np.ndarray, rng: np.random.Generator) -> pd.DataFrame:
+    """
+        SampleAnnot.csv of a donor: one row per tissue sample, about half of them in the left hemisphere
+    """
+    structures = rng.choice(structure_ids, n_samples)
+    hemisphere = rng.choice(["left", "right"], n_samples)
+    return pd.DataFrame({
+        "structure_id": structures,
+        "slab_num": rng.integers(1, 40, n_samples),
+        "well_id": rng.integers(1000, 20000, n_samples),
+        "slab_type": rng.choice(["CX", "CB", "BS"], n_samples),
+        "structure_acronym": [f"S{structure}" for structure in structures],
+        "structure_name": [f"structure {structure}, {side}" for structure, side in zip(structures, hemisphere)],
+        "polygon_id": rng.integers(100000, 1000000, n_samples),
+        "mri_voxel_x": rng.integers(0, 256, n_samples),
+        "mri_voxel_y": rng.integers(0, 256, n_samples),
+        "mri_voxel_z": rng.integers(0, 256, n_samples),
+        "mni_x": np.round(rng.uniform(-70, 70, n_samples), 1),
+        "mni_y": np.round(rng.uniform(-100, 70, n_samples), 1),
+        "mni_z": np.round(rng.uniform(-50, 80, n_samples), 1),
+    })
+
+
+def generate_probes(n_probes: int, n_genes: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+        Probes.csv of the release: probes map to genes, several probes per gene
+    """
+    gene_ids = rng.integers(1, n_genes + 1, n_probes)
+    return pd.DataFrame({
+        "probe_id": np.arange(1058685, 1058685 + n_probes),
+        "probe_name": [f"A_23_P{i}" for i in range(n_probes)],
+        "gene_id": gene_ids,
+        "gene_symbol": [f"G{gene}" for gene in gene_ids],
+        "gene_name": [f"gene {gene}" for gene in gene_ids],
+        "entrez_id": gene_ids + 10000,
+        "chromosome": rng.choice([str(c) for c in range(1, 23)] + ["X", "Y"], n_probes),
+    })
+
+
+def write_microarray_expression(path: Path, probe_ids: np.ndarray, n_samples: int, rng: np.random.Generator) -> None:
+    """
+        MicroarrayExpression.csv of a donor: no header, the probe id followed by one normalized value per sample
+    """
+    with open(path, "w") as f:
+        for start in range(0, len(probe_ids), WRITE_CHUNK_ROWS):
+            stop = min(start + WRITE_CHUNK_ROWS, len(probe_ids))
+            chunk = pd.DataFrame(rng.normal(6.0, 2.0, (stop - start, n_samples)))
+            chunk.insert(0, "probe_id", probe_ids[start:stop])
+            chunk.to_csv(f, header=False, index=False, float_format="%.6f")
+
+
+def generate_dataset(raw_data_path: Path, n_donors: int, n_probes: int, n_samples: int, n_genes: int,
+                     n_structures: int, seed: int = 0) -> List[int]:
+    """
+        Writes n_donors donor directories shaped like the Allen release into raw_data_path and returns their ids.
+        Every donor samples 80% of the shared brain structures, so the meta donor keeps a common subset.
+    """
+    rng = np.random.default_rng(seed)
+    structure_ids = np.arange(4000, 4000 + n_structures)
+    probes = generate_probes(n_probes, n_genes, rng)
+
+    donor_ids = get_donor_ids(n_donors)
+    for donor_id in donor_ids:
+        donor_path = raw_data_path / f"normalized_microarray_donor{donor_id}"
+        donor_path.mkdir(parents=True, exist_ok=True)
+        donor_structures = rng.choice(structure_ids, max(int(0.8 * n_structures), 1), replace=False)
+        generate_sample_annotations(n_samples, donor_structures, rng).to_csv(donor_path / "SampleAnnot.csv", index=False)
+        probes.to_csv(donor_path / "Probes.csv", index=False)
+        write_microarray_expression(donor_path / "MicroarrayExpression.csv", probes["probe_id"].to_numpy(), n_samples, rng)
+    return donor_ids
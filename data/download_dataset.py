@@ -1,64 +1,131 @@
-import logging
+import hashlib
 import zipfile
+import urllib.error
 import urllib.request
 
 from tqdm import tqdm
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
-from src.configs.config_parser import PathConfigParser, data_config_file, project_root
+from src.utils.logger import get_logger
+from src.configs.config_parser import get_config, project_root
 
 
 # Set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger = get_logger(__name__)
 
-# Create a console handler
-sh = logging.StreamHandler()
-sh.setLevel(logging.INFO)
-# Add the handler to the logger
-logger.addHandler(sh)
+# Size of the chunks read from the responses and written to disk
+CHUNK_SIZE = 1 << 20
+# Number of attempts per file, every attempt resumes from the bytes already downloaded
+MAX_ATTEMPTS = 5
+TIMEOUT = 60
 
-def download_file(url: str, download_path: Path) -> Path:
+
+def get_file_name(response, url: str) -> str:
+    """
+        Gets the file name from the Content-Disposition header, or from the URL as fallback.
+    """
+    content_disposition = response.getheader('Content-Disposition')
+    if content_disposition and 'filename=' in content_disposition:
+        # Extract the filename from the Content-Disposition header
+        return content_disposition.split('filename=')[1].split(';')[0].strip('\" ')
+    # If the header is not found, use the URL as fallback
+    return Path(urlparse(url).path).name
+
+
+def get_remote_file_info(url: str) -> Tuple[str, int]:
+    """
+        Gets the file name and size (0 if unknown) of a url without downloading it.
+    """
+    try:
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            return get_file_name(response, url), int(response.getheader('Content-Length', 0))
+    except urllib.error.HTTPError:
+        # Servers without HEAD support, only read the headers of a GET
+        with urllib.request.urlopen(url, timeout=TIMEOUT) as response:
+            return get_file_name(response, url), int(response.getheader('Content-Length', 0))
+
+
+def sha256_file(path: Path) -> str:
+    """
+        Sha256 digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_complete(path: Path, file_size: int, checksum: Optional[str] = None) -> bool:
+    """
+        Whether a downloaded file has the expected size and checksum.
     """
-        Downloads a single file from url.
+    if not path.exists() or (file_size and path.stat().st_size != file_size):
+        return False
+    return checksum is None or sha256_file(path) == checksum
+
+
+def download_file(url: str, download_path: Path, checksum: Optional[str] = None) -> str:
     """
+        Downloads a single file from url, resuming partial downloads with HTTP Range requests.
+        Files already present with the expected size (and sha256 checksum if given) are skipped.
+    """
+    file_name, file_size, pbar = None, 0, None
     try:
-        # Open the URL and get the response headers
-        with urllib.request.urlopen(url) as response:
-            # Check for the Content-Disposition header to get the filename
-            content_disposition = response.getheader('Content-Disposition')
-            if content_disposition and 'attachment' in content_disposition:
-                # Extract the filename from the Content-Disposition header
-                file_name = content_disposition.split('filename=')[1].strip('\"')
-            else:
-                # If the header is not found, use the URL as fallback
-                parsed_url = urlparse(url)
-                file_name = Path(parsed_url.path).name  # Get the file name from the URL path
-
-            # Get the file size from the response headers (for progress bar)
-            file_size = int(response.getheader('Content-Length', 0))
-            
-            # Download the file with the extracted name
-            with open(download_path / file_name, 'wb') as out_file:
-                # Create a tqdm progress bar
-                with tqdm(total=file_size, unit='B', unit_scale=True, desc=file_name) as pbar:
-                    # Download and write the file in chunks
-                    while True:
-                        chunk = response.read(1024)
-                        if not chunk:
-                            break
-                        out_file.write(chunk)
-                        pbar.update(len(chunk))  # Update the progress bar with each chunk
-
-                # out_file.write(response.read())
-            logger.info(f"Downloaded: {file_name}")
-
-            return file_name
-        
-    except Exception as e:
-        logger.info(f"Error downloading {url}: {e}")
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                if file_name is None:
+                    file_name, file_size = get_remote_file_info(url)
+                    file_path = download_path / file_name
+                    if is_complete(file_path, file_size, checksum):
+                        logger.info(f"Already downloaded: {file_name}")
+                        return file_name
+                    # Download into a .part file that survives failures
+                    part_path = download_path / f"{file_name}.part"
+                    pbar = tqdm(total=file_size, unit='B', unit_scale=True, desc=file_name)
+
+                start = part_path.stat().st_size if part_path.exists() else 0
+                if file_size and start >= file_size:
+                    break
+                request = urllib.request.Request(url, headers={"Range": f"bytes={start}-"} if start else {})
+                with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                    # Servers ignoring the Range header send the whole file again
+                    if start and response.status != 206:
+                        start = 0
+                    pbar.reset(total=file_size)
+                    pbar.update(start)
+                    with open(part_path, 'ab' if start else 'wb') as out_file:
+                        # Download and write the file in chunks
+                        for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                            out_file.write(chunk)
+                            pbar.update(len(chunk))
+
+                # A connection closed cleanly before the end returns short data without an error, resume it
+                downloaded = part_path.stat().st_size
+                if not file_size or downloaded >= file_size:
+                    break
+                logger.info(f"Download of {url} ended at {downloaded} of {file_size} bytes "
+                            f"(attempt {attempt}/{MAX_ATTEMPTS}), resuming")
+            except (urllib.error.URLError, OSError) as e:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                logger.info(f"Error downloading {url} (attempt {attempt}/{MAX_ATTEMPTS}), resuming: {e}")
+    finally:
+        if pbar is not None:
+            pbar.close()
+
+    # Reached once the file is complete or the attempts ran out
+    if not is_complete(part_path, file_size, checksum):
+        part_path.unlink()
+        raise IOError(f"Downloaded {file_name} does not match the expected size or checksum")
+    part_path.replace(file_path)
+    logger.info(f"Downloaded: {file_name}")
+
+    return file_name
 
 
 def unzip_file(zip_path: Path, extract_to: Path) -> None:
@@ -71,42 +138,63 @@ def unzip_file(zip_path: Path, extract_to: Path) -> None:
         logger.info(f"Unzipped: {zip_path}")
     except zipfile.BadZipFile:
         logger.info(f"Error unzipping {zip_path}: Not a valid zip file")
-    except Exception as e:
-        logger.info(f"Error unzipping {zip_path}: {e}")
+        raise
 
 
-def get_dataset(dataset_urls: List[str], dataset_path: Path = project_root / Path("data/raw")) -> None:
+def fetch_dataset_file(url: str, dataset_path: Path, checksum: Optional[str] = None, extract: bool = True) -> str:
     """
-        Downloads dataset from the list of dataset_urls given.
+        Downloads a dataset file and unzips it if needed.
+    """
+    logger.info(f"Downloading from URL: {url}")
+    # Download the file
+    file_name = download_file(url, dataset_path, checksum)
+
+    # Unzip the file if needed, the transform can also read the csv files straight out of the archive
+    zip_file_path = dataset_path / file_name
+    if extract and zip_file_path.suffix == '.zip':
+        unzip_dir = dataset_path / file_name.replace(".zip", "")
+        if unzip_dir.exists() and any(unzip_dir.iterdir()):
+            logger.info(f"Already unzipped: {zip_file_path}")
+        else:
+            unzip_dir.mkdir(parents=True, exist_ok=True)  # Create a directory for unzipped files
+            unzip_file(zip_file_path, unzip_dir)
+    return file_name
+
+
+def get_dataset(dataset_urls: List[str], dataset_path: Path = project_root / Path("data/raw"),
+                max_workers: int = 6, checksums: Optional[Dict[str, str]] = None, extract: bool = True) -> List[str]:
+    """
+        Downloads dataset from the list of dataset_urls given, max_workers files at a time.
+        checksums optionally maps urls to the sha256 digest of their file.
+        With extract=False the .zip archives are kept as they are, without writing extracted copies.
     """
     if not dataset_path.exists():
         dataset_path.mkdir(parents=True, exist_ok=True)
+    checksums = checksums or {}
 
-    # Loop through each URL
-    for url in dataset_urls:
-        logger.info(f"Downloading from URL: {url}")
-        # Download the file
-        file_name = download_file(url, dataset_path)
-        
-         # Unzip the file if needed
-        zip_file_path = dataset_path / file_name
-        if zip_file_path.suffix == '.zip':
-            unzip_dir = dataset_path / file_name.replace(".zip", "")
-            if not unzip_dir.exists():
-                unzip_dir.mkdir(parents=True, exist_ok=True)  # Create a directory for unzipped files
-            unzip_file(zip_file_path, unzip_dir)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        jobs = {url: executor.submit(fetch_dataset_file, url, dataset_path, checksums.get(url), extract) for url in dataset_urls}
+
+    # Report every failure before raising
+    failed = []
+    for url, job in jobs.items():
+        if job.exception() is not None:
+            logger.info(f"Error downloading {url}: {job.exception()}")
+            failed.append(url)
+    if failed:
+        raise RuntimeError(f"Failed to download {len(failed)} of {len(dataset_urls)} files: {failed}")
+    return [job.result() for job in jobs.values()]
 
 
 def main():
 # Configs Directory
-    parser = PathConfigParser(str(data_config_file))
-    parser.load()
+    parser = get_config()
 
     # List of Data URLs:
     DATASET_URLS = parser.get("data_urls")
-    
+
     # Download Dataset URLs
-    get_dataset(DATASET_URLS)
+    get_dataset(DATASET_URLS, extract=parser.get("extract_archives", True))
 
 
 if __name__=="__main__":
@@ -1,5 +1,6 @@
 import yaml
 from pathlib import Path
+from functools import lru_cache
 
 # Get the project root directory (works both in notebooks and Python scripts)
 project_root = Path(__file__).resolve().parent.parent.parent  # Going two levels up from config.py
@@ -42,3 +43,12 @@ class PathConfigParser:
                 self.config["data_paths"][key] = [Path(v) for v in value]
 
 
+@lru_cache(maxsize=None)
+def get_config(file_path=data_config_file) -> PathConfigParser:
+    """
+        Loaded configuration of file_path, parsed once per process and shared by every module.
+        Treat it as read only, changes to it are seen by all its users.
+    """
+    parser = PathConfigParser(str(file_path))
+    parser.load()
+    return parser
@@ -1,24 +1,20 @@
-import logging
-import json
+import numpy as np
+from functools import reduce
 from pathlib import Path
+from typing import List
 
 from src.utils.data import *
 from src.utils.memory_management import *
-from src.configs.config_parser import PathConfigParser, data_config_file
+from src.utils.stage_cache import StageCache
+from src.utils.instrumentation import run_report, stage
+from src.utils.logger import get_logger
+from src.configs.config_parser import get_config, project_root
 
 # Set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-# Create a console handler
-sh = logging.StreamHandler()
-sh.setLevel(logging.INFO)
-# Add the handler to the logger
-logger.addHandler(sh)
+logger = get_logger(__name__)
 
 # Configs Directory
-parser = PathConfigParser(str(data_config_file))
-parser.load()
+parser = get_config()
 
 PROCESSED_DATA_PATH = parser.get("data_paths", {}).get("processed_data")
 GE_PATH = parser.get("data_paths", {}).get("brain_regions_genes_ge")
@@ -27,36 +23,107 @@ PROCESSED_DONORS_GE_PATH = PROCESSED_DATA_PATH / GE_PATH
 # Donors_ids
 DONORS_IDS = parser.get("donors_ids")
 
+# Processed formats
+WRITE_LEGACY_CSV = parser.get("processed_formats", {}).get("write_legacy_csv", True)
+
+# Memory budget of the merge, the merged values are spilled to disk if they do not fit
+MEMORY_BUDGET = MemoryBudget.from_gb(parser.get("preprocessing", {}).get("memory_budget_gb"))
+# Bytes per merged value: float32 value, int32 donor and the int64 source and destination indices of the gather
+MERGED_VALUE_BYTES = 24
+
+# Cache of completed stages
+STAGE_CACHE = StageCache(PROCESSED_DATA_PATH / ".stage_cache",
+                         enabled=parser.get("stage_cache", {}).get("enabled", True),
+                         content_digest=parser.get("stage_cache", {}).get("content_digest", False))
+STAGE_CODE = [Path(__file__), project_root / "src" / "utils" / "data.py"]
+
+
+def get_donor_grouped_path(donor: int) -> Path:
+    """
+        Path of the grouped gene expressions of a donor, the columnar store if present or the legacy csv
+    """
+    store_path = PROCESSED_DONORS_GE_PATH / Path(f"{donor}_grouped")
+    return store_path if store_path.is_dir() else PROCESSED_DONORS_GE_PATH / Path(f"{donor}_grouped.csv")
+
+
+def load_donor_grouped_store(donor: int) -> GroupedExpressions:
+    """
+        Loads the grouped gene expressions store of a donor, converting the legacy csv if there is no store
+    """
+    path = get_donor_grouped_path(donor)
+    if path.is_dir():
+        return load_grouped_expressions(path)
+    return grouped_expressions_from_df(load_df_from_csv(path))
+
+
+def order_donor_ids(donor_ids: List[int]) -> List[int]:
+    """
+        Donor ids in the configured donors_ids order, ids missing from it follow in increasing order.
+        The values of a meta donor pair are concatenated in donor order, so every entry point merges in this order.
+    """
+    configured = {donor: rank for rank, donor in enumerate(DONORS_IDS or [])}
+    return sorted(donor_ids, key=lambda donor: (donor not in configured, configured.get(donor, 0), donor))
+
+
+def create_meta_donor(donor_ids: List[int] = DONORS_IDS) -> None:
+    """
+        Merges the grouped gene expressions of the donors over their common brain regions into the meta donor
+    """
+    donor_ids = order_donor_ids(donor_ids)
+    store_path = PROCESSED_DONORS_GE_PATH / "meta_donor"
+    csv_path = PROCESSED_DONORS_GE_PATH / "meta_donor.csv"
+
+    # Skip the merge if the meta donor is up to date
+    stage_name = "create_meta_donor_csv"
+    inputs = [get_donor_grouped_path(donor) for donor in donor_ids]
+    outputs = [store_path, csv_path] if WRITE_LEGACY_CSV else [store_path]
+    key = STAGE_CACHE.key(inputs=inputs, config={"donor_ids": list(donor_ids), "write_legacy_csv": WRITE_LEGACY_CSV},
+                          code=STAGE_CODE)
+    if STAGE_CACHE.is_valid(stage_name, key):
+        logger.info("Skipping meta donor, outputs are up to date")
+        return
+
+    with stage(stage_name, MEMORY_BUDGET) as record:
+        donor_stores = []
+
+        # Loading previously transformed stores (memory-mapped) and creating the meta donor
+        for donor in donor_ids:
+            donor_store = load_donor_grouped_store(donor)
+            logger.info(f"Donor Id: {str(donor)}")
+            logger.info(f"Number of brain regions: {len(np.unique(donor_store.brain_region))}")
+            logger.info(f"Number of gene ids: {len(np.unique(donor_store.gene_id))}")
+            donor_stores.append(donor_store)
+
+        # Finding common brain regions and filtering the others out
+        common_brain_regions = reduce(np.intersect1d, (np.unique(store.brain_region) for store in donor_stores))
+        logger.info(f"Number of common brain regions: {len(common_brain_regions)}")
+
+        # Spill the merged values straight to the store if they do not fit in the memory budget
+        n_values = sum(int(np.isin(store.brain_region, common_brain_regions) @ store.sample_counts) for store in donor_stores)
+        spill = not MEMORY_BUDGET.fits(n_values * MERGED_VALUE_BYTES)
+        if spill:
+            logger.info(f"Merging {n_values} values into {store_path} on disk to stay within the memory budget")
+
+        # Concatenate the values of the donors per Brain Region-Gene Id pair
+        meta_donor = merge_grouped_expressions(donor_stores, donor_ids, brain_regions=common_brain_regions,
+                                               out_path=store_path if spill else None)
+        logger.info(f"meta_donor size: {len(meta_donor)} pairs, {len(meta_donor.values)} values")
+        logger.info(f"Meta Donor has only list of common_brain_regions: {np.array_equal(np.unique(meta_donor.brain_region), common_brain_regions)}")
+
+        if not spill:
+            write_grouped_expressions(meta_donor, store_path)
+        if WRITE_LEGACY_CSV:
+            write_grouped_expressions_to_csv(meta_donor, csv_path)
+        record.add_rows(len(meta_donor))
+        record.add_bytes_read(inputs)
+        record.add_bytes_written(outputs)
+    STAGE_CACHE.record(stage_name, key, outputs)
+
+
 def main():
-    donor_ges = []
-
-    # Loading previously transformed files and creating the meta_donor.csv file
-    for donor in DONORS_IDS:
-        # Load donor .csv from processed data 
-        donor_ge = load_df_from_csv(PROCESSED_DONORS_GE_PATH / Path(f"{donor}_grouped.csv"))
-        logger.info(f"Donor Id: {str(donor)}")
-        logger.info(f"Number of brain regions: {donor_ge['brain_region'].nunique()}")
-        logger.info(f"Number of gene ids: {donor_ge['gene_id'].nunique()}")
-        donor_ge["gene_expression_values"]=donor_ge["gene_expression_values"].apply(json.loads)
-        donor_ges.append(donor_ge)
-        deallocate_df(donor_ge)
-
-    # Finding common brain regions and filtering the others out
-    common_brain_regions = set.intersection(*(set(donor_ge['brain_region']) for donor_ge in donor_ges))
-    logger.info(f"Number of common brain regions: {len(common_brain_regions)}")
-
-    # Keep only the common columns in each DataFrame
-    filtered_donors_ges = [donor_ge[donor_ge['brain_region'].isin(common_brain_regions)] for donor_ge in donor_ges]
-    set(filtered_donors_ges[3]['brain_region'])==common_brain_regions
-
-    # Concatenate all filtered DataFrames
-    meta_donor_df = pd.concat(filtered_donors_ges, ignore_index=True)
-    logger.info(f"meta_donor_df size:{len(meta_donor_df)}")
-    logger.info(f"Meta Donor DF has only list of common_brain_regions: {set(meta_donor_df['brain_region'])==common_brain_regions}")
-
-    concatenated_ges = meta_donor_df.groupby(["brain_region", "gene_id"])["gene_expression_values"].apply(lambda x: sum(x, [])).reset_index()
-
-    write_df_to_csv(concatenated_ges, PROCESSED_DONORS_GE_PATH / f"meta_donor.csv")
+    with run_report("create_meta_donor_csv"):
+        create_meta_donor(DONORS_IDS)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,70 @@
+import os
+from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor
+
+from src.preprocessing import transform_data, create_meta_donor_csv, transform_data_json
+from src.utils.instrumentation import run_report, stage
+from src.utils.logger import get_logger
+from src.configs.config_parser import get_config
+
+# Set up logger
+logger = get_logger(__name__)
+
+# Configs Directory
+parser = get_config()
+
+MAX_WORKERS = parser.get("preprocessing", {}).get("max_workers")
+MEMORY_BUDGET_GB = parser.get("preprocessing", {}).get("memory_budget_gb", 16)
+DONOR_MEMORY_GB = parser.get("preprocessing", {}).get("donor_memory_gb", 4)
+
+
+def get_number_of_workers(n_donors: int, max_workers: Optional[int] = MAX_WORKERS,
+                          memory_budget_gb: float = MEMORY_BUDGET_GB, donor_memory_gb: float = DONOR_MEMORY_GB) -> int:
+    """
+        Number of donors processed concurrently, capped by the cores, the donors and the memory budget
+    """
+    workers = min(max_workers or os.cpu_count() or 1, n_donors)
+    if donor_memory_gb:
+        workers = min(workers, int(memory_budget_gb // donor_memory_gb))
+    return max(workers, 1)
+
+
+def run_pipeline(max_workers: Optional[int] = MAX_WORKERS, memory_budget_gb: float = MEMORY_BUDGET_GB,
+                 donor_memory_gb: float = DONOR_MEMORY_GB, create_json: bool = True) -> List[int]:
+    """
+        Runs the preprocessing of all donors concurrently, then merges them into the meta donor.
+        Returns the ids of the processed donors.
+    """
+    donor_dirs = transform_data.get_donor_dirs()
+    workers = get_number_of_workers(len(donor_dirs), max_workers, memory_budget_gb, donor_memory_gb)
+    logger.info(f"Processing {len(donor_dirs)} donors with {workers} workers")
+
+    # Stages of the donors run in the workers, their own records are only logged
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Map: transform the raw data of every donor
+        with stage("pipeline/transform_data") as record:
+            donor_ids = list(executor.map(transform_data.transform_donor, donor_dirs))
+            record.add_rows(len(donor_ids))
+
+        # Reduce: merge the donors over their common brain regions
+        create_meta_donor_csv.create_meta_donor(donor_ids)
+
+        # Hierarchical json files of every donor and the meta donor
+        if create_json:
+            with stage("pipeline/transform_data_json") as record:
+                json_jobs = [executor.submit(transform_data_json.create_donor_json, donor) for donor in donor_ids]
+                json_jobs.append(executor.submit(transform_data_json.create_meta_donor_json))
+                for job in json_jobs:
+                    job.result()
+                record.add_rows(len(json_jobs))
+
+    return donor_ids
+
+
+def main():
+    with run_report("pipeline"):
+        run_pipeline()
+
+
+if __name__ == "__main__":
+    main()
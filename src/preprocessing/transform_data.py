@@ -1,29 +1,48 @@
 import re
-import json
-import logging
+import numpy as np
 from pathlib import Path
+from typing import List, Optional, Tuple
 
 from src.utils.data import *
 from src.utils.memory_management import *
-from src.configs.config_parser import PathConfigParser, data_config_file
+from src.utils.stage_cache import StageCache
+from src.utils.instrumentation import run_report, stage
+from src.utils.logger import get_logger
+from src.configs.config_parser import get_config, project_root
 
 # Set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-# Create a console handler
-sh = logging.StreamHandler()
-sh.setLevel(logging.INFO)
-# Add the handler to the logger
-logger.addHandler(sh)
+logger = get_logger(__name__)
 
 # Configs Directory
-parser = PathConfigParser(str(data_config_file))
-parser.load()
+parser = get_config()
 
 # Access paths
 RAW_DATA_PATH = parser.get("data_paths", {}).get("raw_data") 
 PROCESSED_DATA_PATH = parser.get("data_paths", {}).get("processed_data")
+GE_PATH = parser.get("data_paths", {}).get("brain_regions_genes_ge")
+PROCESSED_DONORS_GE_PATH = PROCESSED_DATA_PATH / GE_PATH
+
+# Processed formats
+WRITE_LEGACY_CSV = parser.get("processed_formats", {}).get("write_legacy_csv", True)
+
+# Number of probe rows of MicroarrayExpression.csv parsed at once
+CHUNK_SIZE = parser.get("preprocessing", {}).get("chunk_size", 2000)
+# Parser of SampleAnnot.csv and Probes.csv, "c" or "pyarrow" (MicroarrayExpression.csv is read in chunks by the c parser)
+READ_ENGINE = parser.get("preprocessing", {}).get("csv_engine", "c")
+
+# Memory budget of one donor transform, MicroarrayExpression.csv chunks shrink to fit in it
+MEMORY_BUDGET = MemoryBudget.from_gb(parser.get("preprocessing", {}).get("donor_memory_gb"))
+# Bytes per parsed expression value of a chunk: parser buffers, float32 value and int64 position temporaries
+CHUNK_VALUE_BYTES = 48
+
+# Raw files of a donor read by the transform
+DONOR_FILES = ["SampleAnnot.csv", "Probes.csv", "MicroarrayExpression.csv"]
+
+# Cache of completed stages
+STAGE_CACHE = StageCache(PROCESSED_DATA_PATH / ".stage_cache",
+                         enabled=parser.get("stage_cache", {}).get("enabled", True),
+                         content_digest=parser.get("stage_cache", {}).get("content_digest", False))
+STAGE_CODE = [Path(__file__), project_root / "src" / "utils" / "data.py"]
 
 # Transformation Helper Functions
 def transform_sample_annotations(donor_sa: pd.DataFrame, left_mask : pd.Series) -> pd.DataFrame:
@@ -32,10 +51,8 @@ def transform_sample_annotations(donor_sa: pd.DataFrame, left_mask : pd.Series)
     """
     # Keep certain columns in the SampleAnnot.csv file
     donor_sa_processed = keep_df_cols(donor_sa, ["structure_id", "structure_name"])
-    deallocate_df(donor_sa)
     # Applying mask on Sample annotations file
     donor_sa_filtered= donor_sa_processed[left_mask].reset_index(drop=True)
-    deallocate_df(donor_sa_processed)
     return donor_sa_filtered
 
 
@@ -47,52 +64,144 @@ def transform_gene_expressions(donor_ge: pd.DataFrame, left_mask : pd.Series) ->
     left_mask_ge = pd.concat([pd.Series([True], index=[0]), left_mask], ignore_index=True)
     left_mask_ge_filtered = left_mask_ge[left_mask_ge].index.values.tolist()
     donor_ge_filtered  = donor_ge.iloc[:, left_mask_ge_filtered]
-    deallocate_df(donor_ge)
     return donor_ge_filtered
 
 
-def main():
+def _group_ranks(codes: np.ndarray, n_groups: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Rank of every element among the elements of the same group (in order of appearance) and group sizes
+    """
+    order = np.argsort(codes, kind="stable")
+    sizes = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    ranks = np.empty(len(codes), dtype=np.int64)
+    ranks[order] = np.arange(len(codes)) - starts[codes[order]]
+    return ranks, sizes
+
+
+def transform_donor_streaming(donor_path: Path, output_path: Path, chunksize: int = CHUNK_SIZE,
+                              budget: MemoryBudget = MEMORY_BUDGET,
+                              memory: Optional[StageMemory] = None) -> GroupedExpressions:
+    """
+        Streams MicroarrayExpression.csv of a donor in row chunks into a grouped expressions store.
+        Every value is written straight to its final position, keeping the order of the melt-and-group transform.
+        donor_path is the donor directory or its .zip archive, which is read without extracting it.
+        Chunks shrink below chunksize rows (down to MIN_CHUNK_FRACTION of it) when they would not fit in the memory budget,
+        the memory of the annotation frames is recorded in memory if given.
+    """
+    memory = memory or StageMemory(str(donor_path))
+    with released_frames() as frames:
+        # Processing SampleAnnot to get the brain region id ("structure id") of the left hemisphere columns
+        with open_donor_file(donor_path, "SampleAnnot.csv") as f:
+            frames["donor_sa"] = memory.track_df("SampleAnnot.csv", read_csv(f, SAMPLE_ANNOT_SCHEMA, READ_ENGINE))
+        left_mask = mask_left_hemisphere(frames["donor_sa"]).to_numpy()
+        left_columns = np.flatnonzero(left_mask)
+        brain_regions, region_codes = np.unique(frames["donor_sa"]["structure_id"].to_numpy()[left_mask], return_inverse=True)
+        column_ranks, region_sizes = _group_ranks(region_codes, len(brain_regions))
+
+        # Load probes data to get the gene id of each probe
+        with open_donor_file(donor_path, "Probes.csv") as f:
+            frames["donor_probes"] = memory.track_df("Probes.csv", read_csv(f, PROBES_SCHEMA, READ_ENGINE))
+        probes_with_gene = frames["donor_probes"][frames["donor_probes"]["gene_id"].notna()]
+        n_probes = len(probes_with_gene)
+        gene_ids, gene_codes = np.unique(probes_with_gene["gene_id"].to_numpy(dtype=np.int32), return_inverse=True)
+        probe_ranks, gene_sizes = _group_ranks(gene_codes, len(gene_ids))
+        probe_index = pd.Index(probes_with_gene["probe_id"])
+        del probes_with_gene
+
+    # Every Brain Region-Gene Id pair holds region samples x gene probes values, sorted by brain region then gene id
+    counts = np.outer(region_sizes, gene_sizes).ravel()
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    store = allocate_grouped_expressions(output_path,
+                                         brain_region=np.repeat(brain_regions, len(gene_ids)),
+                                         gene_id=np.tile(gene_ids, len(brain_regions)),
+                                         offsets=offsets)
+
+    # Applying the left hemisphere mask at parse time, the file has no header and starts with the probe id
+    usecols = [0] + (left_columns + 1).tolist()
+    dtypes = {column: EXPRESSION_SCHEMA for column in usecols[1:]}
+    dtypes[0] = PROBES_SCHEMA["probe_id"]
+    row_bytes = len(usecols) * CHUNK_VALUE_BYTES
+    budget.check(f"{donor_path.name}: MicroarrayExpression.csv")
+    rows_written = 0
+    with open_donor_file(donor_path, "MicroarrayExpression.csv") as f, \
+            pd.read_csv(f, header=None, usecols=usecols, dtype=dtypes, iterator=True) as reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(budget.fit_chunk_size(chunksize, row_bytes))
+            except StopIteration:
+                break
+            probes = probe_index.get_indexer(chunk[0].to_numpy())
+            valid = probes >= 0
+            probes = probes[valid]
+            chunk_values = chunk.loc[valid, usecols[1:]].to_numpy(dtype=np.float32)
+
+            # Position of (probe, sample): pair offset + sample rank in region * gene probes + probe rank in gene
+            chunk_genes = gene_codes[probes]
+            pair_offsets = offsets[:-1][region_codes[None, :] * len(gene_ids) + chunk_genes[:, None]]
+            positions = pair_offsets + column_ranks[None, :] * gene_sizes[chunk_genes][:, None] + probe_ranks[probes][:, None]
+            store.values[positions] = chunk_values
+            rows_written += len(probes)
+
+    if rows_written != n_probes:
+        raise ValueError(f"Expected {n_probes} probes in {donor_path}, found {rows_written}")
+    store.values.flush()
+    logger.info(f"Brain regions: {len(brain_regions)}, gene ids: {len(gene_ids)}, values: {offsets[-1]}")
+
+    return store
+
+
+def get_donor_dirs() -> List[Path]:
+    """
+        Lists the raw data of the downloaded donors: their directories, or their .zip archives if not extracted
+    """
     donor_pattern = r"^normalized_microarray_donor\d+$"
     donor_dirs = [d for d in RAW_DATA_PATH.iterdir() if d.is_dir() and re.match(donor_pattern, d.name)]
+    extracted = {d.name for d in donor_dirs}
+    donor_zips = [z for z in RAW_DATA_PATH.iterdir()
+                  if z.suffix == ".zip" and re.match(donor_pattern, z.stem) and z.stem not in extracted]
+    # Independent of the directory listing order
+    return sorted(donor_dirs + donor_zips, key=get_donor_id_from_path)
+
 
-    # Processing Each donor file
-    for donor_path in donor_dirs:
-        logger.info(f"Processing data of {donor_path}")
-
-        # Processing SampleAnnot to get the brain region id ("structure id")
-        donor_sa = load_df_from_csv(donor_path / "SampleAnnot.csv")
-        # Create a mask for left hemisphere entries
-        left_mask = mask_left_hemisphere(donor_sa)
-        # Transform donor_sa
-        donor_sa_filtered = transform_sample_annotations(donor_sa, left_mask)
-
-        # Loading Gene Expressions
-        donor_ge = load_df_from_csv(donor_path / "MicroarrayExpression.csv")
-        # Transform Gene Expressions
-        donor_ge_filtered = transform_gene_expressions(donor_ge, left_mask)
-        # Load probes data 
-        donor_probes = load_df_from_csv(donor_path / "Probes.csv")
-        # Add Brain Region id as a column name in the gene_expression data
-        donor_ge_filtered.columns = ['probe_id'] + list(donor_sa_filtered["structure_id"])
-        deallocate_df(donor_sa_filtered)
-        # Add gene_id Column in the gene_expressions data
-        donor_ge_filtered.insert(0, 'gene_id', donor_probes['gene_id'])
-
-        # Drop probe_id column        
-        donor_ge_filtered = donor_ge_filtered.drop(columns=['probe_id'])
-        
-        # Create a new CSV with grouped gene_ids by melting the DataFrame to make it easier to manipulate
-        df_melted = donor_ge_filtered.melt(id_vars=["gene_id"], var_name="brain_region", value_name="gene_expression_values")
-        # Now, group by brain_region and gene_id  and aggregate the test values into lists
-        df_grouped = df_melted.groupby(["brain_region", "gene_id"])["gene_expression_values"].apply(list).reset_index()
-        # *Apply json dumps to be able to load the file appropiately
-        df_grouped["gene_expression_values"] = df_grouped["gene_expression_values"].apply(json.dumps)
-        # Save the grouped csvs per each donor
-        write_df_to_csv(df_grouped, PROCESSED_DATA_PATH / f"brain_regions_genes_geneexpressions/{get_donor_id_from_path(donor_path)}_grouped.csv")
-        deallocate_df(df_melted)
-        deallocate_df(donor_ge_filtered)
+def transform_donor(donor_path: Path) -> int:
+    """
+        Transforms the raw data of a donor into its grouped store (and legacy csv) and returns the donor id
+    """
+    donor_id = get_donor_id_from_path(donor_path)
+    store_path = PROCESSED_DONORS_GE_PATH / f"{donor_id}_grouped"
+    csv_path = PROCESSED_DONORS_GE_PATH / f"{donor_id}_grouped.csv"
+
+    # Skip donors whose outputs are up to date
+    stage_name = f"transform_data/{donor_id}"
+    inputs = [donor_path] if donor_path.suffix == ".zip" else [donor_path / name for name in DONOR_FILES]
+    outputs = [store_path, csv_path] if WRITE_LEGACY_CSV else [store_path]
+    key = STAGE_CACHE.key(inputs=inputs, config={"write_legacy_csv": WRITE_LEGACY_CSV}, code=STAGE_CODE)
+    if STAGE_CACHE.is_valid(stage_name, key):
+        logger.info(f"Skipping data of {donor_path}, outputs are up to date")
+        return donor_id
+
+    logger.info(f"Processing data of {donor_path}")
+    with stage(stage_name, MEMORY_BUDGET) as record:
+        # Stream the gene expressions into the grouped store of the donor
+        store = transform_donor_streaming(donor_path, store_path, memory=record.memory)
+        if WRITE_LEGACY_CSV:
+            # Save the grouped csvs per each donor
+            write_grouped_expressions_to_csv(store, csv_path)
+        record.add_rows(len(store))
+        record.add_bytes_read(inputs)
+        record.add_bytes_written(outputs)
+    STAGE_CACHE.record(stage_name, key, outputs)
+    return donor_id
+
+
+def main():
+    with run_report("transform_data"):
+        # Processing Each donor file
+        for donor_path in get_donor_dirs():
+            transform_donor(donor_path)
 
 
 if __name__ == "__main__":
     main()
-   
\ No newline at end of file
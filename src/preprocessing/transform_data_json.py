@@ -1,26 +1,19 @@
 import json
 from ast import literal_eval
-import logging
 from pathlib import Path
 
 from src.utils.data import *
 from src.utils.memory_management import *
-from src.configs.config_parser import PathConfigParser, data_config_file
+from src.utils.stage_cache import StageCache
+from src.utils.instrumentation import run_report, stage
+from src.utils.logger import get_logger
+from src.configs.config_parser import get_config, project_root
 
 # Set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-# Create a console handler
-sh = logging.StreamHandler()
-sh.setLevel(logging.INFO)
-
-# Add the handler to the logger
-logger.addHandler(sh)
+logger = get_logger(__name__)
 
 # Configs Directory
-parser = PathConfigParser(str(data_config_file))
-parser.load()
+parser = get_config()
 
 # Access paths 
 PROCESSED_DATA_PATH = parser.get("data_paths", {}).get("processed_data")
@@ -30,6 +23,15 @@ PROCESSED_DONORS_GE_PATH = PROCESSED_DATA_PATH / GE_PATH
 # Donors_ids
 DONORS_IDS = parser.get("donors_ids")
 
+# Hierarchical output format, "json" or "binary"
+HIERARCHICAL_FORMAT = parser.get("processed_formats", {}).get("hierarchical_format", "json")
+
+# Cache of completed stages
+STAGE_CACHE = StageCache(PROCESSED_DATA_PATH / ".stage_cache",
+                         enabled=parser.get("stage_cache", {}).get("enabled", True),
+                         content_digest=parser.get("stage_cache", {}).get("content_digest", False))
+STAGE_CODE = [Path(__file__), project_root / "src" / "utils" / "data.py"]
+
 def write_geneexpressions_to_json(df: pd.DataFrame, pth: Path) -> None:
     """
         Specific to writing gene_expression files to json and keep the lists as numbers
@@ -52,18 +54,78 @@ def write_geneexpressions_to_json(df: pd.DataFrame, pth: Path) -> None:
         json.dump(grouped, f, indent=4)
 
 
+def load_grouped_store(name: str) -> GroupedExpressions:
+    """
+        Loads the grouped store <name> (memory-mapped), converting the legacy <name>.csv if there is no store
+    """
+    store_path = PROCESSED_DONORS_GE_PATH / Path(name)
+    if store_path.is_dir():
+        return load_grouped_expressions(store_path)
+    return grouped_expressions_from_df(load_df_from_csv(PROCESSED_DONORS_GE_PATH / Path(f"{name}.csv")))
+
+
+def create_grouped_json(name: str, output_format: str = HIERARCHICAL_FORMAT) -> None:
+    """
+        Creates the hierarchical output of the grouped store <name> (a donor or the meta donor).
+        "json" writes <name>.json, "binary" makes sure the store exists with its brain region index,
+        so load_brain_region can read one region without touching the rest.
+    """
+    if output_format not in ("json", "binary"):
+        raise ValueError(f"Unsupported hierarchical format: {output_format}")
+    store_path = PROCESSED_DONORS_GE_PATH / Path(name)
+    source_path = store_path if store_path.is_dir() else PROCESSED_DONORS_GE_PATH / Path(f"{name}.csv")
+    json_path = PROCESSED_DONORS_GE_PATH / Path(f"{name}.json")
+    outputs = [json_path] if output_format == "json" else [store_path]
+
+    # Skip files that are up to date
+    stage_name = f"transform_data_json/{name}"
+    key = STAGE_CACHE.key(inputs=[source_path], config={"hierarchical_format": output_format}, code=STAGE_CODE)
+    if STAGE_CACHE.is_valid(stage_name, key):
+        logger.info(f"Skipping {name} {output_format} output, it is up to date")
+        return
+
+    with stage(stage_name) as record:
+        store = load_grouped_store(name)
+        if output_format == "json":
+            # Stream the grouped store into the json file without building the whole hierarchy
+            write_grouped_expressions_to_json(store, json_path, indent=4)
+        elif not store_path.is_dir():
+            # Legacy csv only, convert it into an indexed store
+            write_grouped_expressions(store, store_path)
+        elif not (store_path / "regions.npy").exists():
+            # Store written before the brain region index existed
+            write_brain_region_index(store, store_path)
+        record.add_rows(len(store))
+        record.add_bytes_read(source_path)
+        if output_format == "json":
+            record.add_bytes_written(json_path)
+    STAGE_CACHE.record(stage_name, key, outputs)
+
+
+def create_donor_json(donor: int) -> None:
+    """
+        Creates the hierarchical json file (or binary index) of a donor out of its grouped store
+    """
+    logger.info(f"Creating donor id: {str(donor)} {HIERARCHICAL_FORMAT} file")
+    create_grouped_json(f"{donor}_grouped")
+
+
+def create_meta_donor_json() -> None:
+    """
+        Creates the hierarchical json file (or binary index) of the meta donor out of its grouped store
+    """
+    logger.info(f"Creating meta_donor {HIERARCHICAL_FORMAT} file")
+    create_grouped_json("meta_donor")
+
+
 def main():
-    # Creating Json files for Hierarchal Data
-    for donor in DONORS_IDS:
-        logger.info(f"Creating donor id: {str(donor)} json file")
-        # Load donor csv from processed data 
-        donor_ge = load_df_from_csv(PROCESSED_DONORS_GE_PATH / Path(f"{donor}_grouped.csv"))
-        write_geneexpressions_to_json(donor_ge, PROCESSED_DONORS_GE_PATH / Path(f"{donor}_grouped.json"))
-    # Creating Meta Donor Json File
-    logger.info(f"Creating meta_donor.json file")
-    meta_donor_ge = load_df_from_csv(PROCESSED_DONORS_GE_PATH / Path(f"meta_donor.csv"))
-    write_geneexpressions_to_json(meta_donor_ge, PROCESSED_DONORS_GE_PATH / Path(f"meta_donor.json"))
+    with run_report("transform_data_json"):
+        # Creating Json files for Hierarchal Data
+        for donor in DONORS_IDS:
+            create_donor_json(donor)
+        # Creating Meta Donor Json File
+        create_meta_donor_json()
 
     
 if __name__== "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,13 +1,58 @@
+import json
+import zipfile
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
-from typing import List
+from itertools import groupby
+from typing import BinaryIO, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 from pathlib import Path
 
 
-def load_df_from_csv(path: Path) -> pd.DataFrame:
+# Column dtypes of the Allen raw files, applied at parse time instead of the inferred int64/float64/object
+SAMPLE_ANNOT_SCHEMA = {
+    "structure_id": np.int32, "slab_num": np.int32, "well_id": np.int32, "polygon_id": np.int32,
+    "slab_type": "category", "structure_acronym": "category", "structure_name": "category",
+    "mri_voxel_x": np.int32, "mri_voxel_y": np.int32, "mri_voxel_z": np.int32,
+    "mni_x": np.float32, "mni_y": np.float32, "mni_z": np.float32,
+}
+# gene_id and entrez_id can be missing, nullable integers keep them 32 bit
+PROBES_SCHEMA = {
+    "probe_id": np.int32, "gene_id": "Int32", "entrez_id": "Int32",
+    "gene_symbol": "category", "chromosome": "category",
+}
+# MicroarrayExpression.csv holds the probe id followed by the expression values, all parsed as float32
+EXPRESSION_SCHEMA = np.float32
+# Brain Region-Gene Id keys of the processed files (grouped, meta donor, filtered and stats csvs)
+KEYS_SCHEMA = {"brain_region": np.int32, "gene_id": np.int32}
+CSV_SCHEMAS = {
+    "SampleAnnot.csv": SAMPLE_ANNOT_SCHEMA,
+    "Probes.csv": PROBES_SCHEMA,
+    "MicroarrayExpression.csv": EXPRESSION_SCHEMA,
+}
+# "c" or "pyarrow", the pyarrow engine parses with multiple threads
+CSV_ENGINE = "c"
+
+
+def get_csv_schema(path: Path) -> Union[dict, type]:
+    """
+        Schema of a csv file by its name, processed files fall back to the Brain Region-Gene Id keys schema
+    """
+    return CSV_SCHEMAS.get(Path(path).name, KEYS_SCHEMA)
+
+
+def read_csv(source: Union[Path, BinaryIO], schema: Union[dict, type, None] = None,
+             engine: Optional[str] = None, **kwargs) -> pd.DataFrame:
+    """
+        Reads a csv path or file object applying the schema dtypes at parse time, columns missing from the schema are inferred
     """
-        Loads df from csv path
+    return pd.read_csv(source, dtype=schema, engine=engine or CSV_ENGINE, **kwargs)
+
+
+def load_df_from_csv(path: Path, schema: Union[dict, type, None] = None, engine: Optional[str] = None) -> pd.DataFrame:
     """
-    return pd.read_csv(path)
+        Loads df from csv path, with the schema of the file (see get_csv_schema) unless one is given
+    """
+    return read_csv(path, schema if schema is not None else get_csv_schema(path), engine)
 
 def write_df_to_csv(df: pd.DataFrame, path:Path) -> None:  
     """
@@ -18,6 +63,23 @@ def write_df_to_csv(df: pd.DataFrame, path:Path) -> None:
     df.to_csv(path, index=False)
 
 
+@contextmanager
+def open_donor_file(donor_source: Path, name: str) -> Iterator[BinaryIO]:
+    """
+        Opens a raw file of a donor from its directory, or streams it straight out of the donor .zip archive
+    """
+    if donor_source.suffix == ".zip":
+        with zipfile.ZipFile(donor_source) as archive:
+            members = [member for member in archive.namelist() if Path(member).name == name]
+            if not members:
+                raise FileNotFoundError(f"{name} not found in {donor_source}")
+            with archive.open(members[0]) as f:
+                yield f
+    else:
+        with open(donor_source / name, "rb") as f:
+            yield f
+
+
 def keep_df_cols(df:  pd.DataFrame, cols: List) -> pd.DataFrame: 
     """
         General helper for keeping cols in a column list
@@ -47,6 +109,9 @@ def get_donor_id_from_path (path: Path) -> int:
         Retrieves the donor id from the path
     """
     number = ""
+    # Donor archives end with .zip after the id
+    if Path(path).suffix == ".zip":
+        path = Path(path).with_suffix("")
     for char in reversed(str(path)):
         if char.isdigit():
             number = char + number
@@ -64,9 +129,396 @@ def mask_left_hemisphere(sample_annotations: pd.DataFrame) -> pd.Series:
     return sample_annotations['structure_name'].str.contains(r'\bleft\b', case=False, na=False)
 
 
+# Sorted sample counts of the brain_region gene_id pairs, answering thresholds by binary search
+class SampleCountIndex:
+    """
+        Index over the number of samples of every Brain Region-Gene Id pair of a df or grouped expressions store
+    """
+    def __init__(self, sample_counts: np.ndarray):
+        self.sample_counts = np.asarray(sample_counts)
+        self._order = np.argsort(self.sample_counts, kind="stable")
+        self._sorted_counts = self.sample_counts[self._order]
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame) -> "SampleCountIndex":
+        """
+            Uses the sample_count column if the df has one, otherwise counts the gene_expression_values lists once
+        """
+        if "sample_count" in df.columns:
+            return cls(df["sample_count"].to_numpy())
+        return cls(df["gene_expression_values"].apply(len).to_numpy())
+
+    @classmethod
+    def from_store(cls, store: "GroupedExpressions") -> "SampleCountIndex":
+        return cls(store.sample_counts)
+
+    def count_at_least(self, thresholds: Iterable[int]) -> np.ndarray:
+        """
+            Number of pairs with at least each threshold of samples
+        """
+        return len(self._sorted_counts) - np.searchsorted(self._sorted_counts, np.asarray(list(thresholds)), side="left")
+
+    def positions_at_least(self, threshold: int) -> np.ndarray:
+        """
+            Row positions, in row order, of the pairs with at least threshold samples
+        """
+        start = np.searchsorted(self._sorted_counts, threshold, side="left")
+        return np.sort(self._order[start:])
+
+
 # Masking only brain_region gene_id pairs that have more than a certain threshold of samples
-def mask_samples_threshold(df: pd.DataFrame, threshold: int) -> pd.DataFrame:
+def mask_samples_threshold(df: pd.DataFrame, threshold: int, index: Optional[SampleCountIndex] = None) -> pd.DataFrame:
+    """
+        Filtering out Brain-Region Gene-Id Pairs that have samples fewer than a threshold, using the count index if given
     """
-        Filtering out Brain-Region Gene-Id Pairs that have samples fewer than a threshold
+    index = index or SampleCountIndex.from_df(df)
+    return df.iloc[index.positions_at_least(threshold)]
+
+
+# Columnar ragged-array store for grouped gene expression values
+class GroupedExpressions(NamedTuple):
     """
-    return df[df['gene_expression_values'].apply(len) >= threshold]
\ No newline at end of file
+        Ragged array of gene expression values grouped by Brain Region-Gene Id pair.
+        The values of pair i are values[offsets[i]:offsets[i + 1]], donor optionally holds the donor id of each value.
+    """
+    brain_region: np.ndarray
+    gene_id: np.ndarray
+    offsets: np.ndarray
+    values: np.ndarray
+    donor: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.brain_region)
+
+    @property
+    def sample_counts(self) -> np.ndarray:
+        """
+            Number of samples of each Brain Region-Gene Id pair
+        """
+        return np.diff(self.offsets)
+
+    def get_values(self, i: int) -> np.ndarray:
+        """
+            Gene expression values of the i-th Brain Region-Gene Id pair
+        """
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+
+GROUPED_STORE_ARRAYS = ("brain_region", "gene_id", "offsets", "values")
+BRAIN_REGION_INDEX_ARRAYS = ("regions", "region_offsets")
+
+
+def grouped_expressions_from_df(df: pd.DataFrame, dtype: np.dtype = np.float32) -> GroupedExpressions:
+    """
+        Builds the ragged store from a grouped df with a gene_expression_values list column
+    """
+    ge_values = df["gene_expression_values"]
+    # Accept the json strings of the legacy grouped csv files as well
+    if len(ge_values) and isinstance(ge_values.iloc[0], str):
+        ge_values = ge_values.apply(json.loads)
+
+    counts = ge_values.apply(len).to_numpy(dtype=np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    values = np.fromiter((v for sample in ge_values for v in sample), dtype=dtype, count=int(offsets[-1]))
+
+    return GroupedExpressions(brain_region=df["brain_region"].to_numpy(dtype=np.int32),
+                              gene_id=df["gene_id"].to_numpy(dtype=np.int32),
+                              offsets=offsets,
+                              values=values)
+
+
+def grouped_expressions_to_df(store: GroupedExpressions, sample_count: bool = False) -> pd.DataFrame:
+    """
+        Converts the ragged store back into a grouped df with a gene_expression_values list column,
+        and a sample_count column taken from the offsets if sample_count is set
+    """
+    values = np.asarray(store.values)
+    df = pd.DataFrame({
+        "brain_region": np.asarray(store.brain_region),
+        "gene_id": np.asarray(store.gene_id),
+        "gene_expression_values": [values[start:end].tolist() for start, end in zip(store.offsets[:-1], store.offsets[1:])],
+    })
+    if sample_count:
+        df["sample_count"] = store.sample_counts
+    return df
+
+
+def write_grouped_expressions(store: GroupedExpressions, path: Path) -> None:
+    """
+        Writes the ragged store as a directory of .npy arrays
+    """
+    path.mkdir(parents=True, exist_ok=True)
+    for name in GROUPED_STORE_ARRAYS:
+        np.save(path / f"{name}.npy", np.asarray(getattr(store, name)))
+    if store.donor is not None:
+        np.save(path / "donor.npy", np.asarray(store.donor))
+    elif (path / "donor.npy").exists():
+        (path / "donor.npy").unlink()
+    # Stores sorted by brain region get a region index for load_brain_region
+    if is_sorted_by_brain_region(store):
+        write_brain_region_index(store, path)
+    else:
+        for name in BRAIN_REGION_INDEX_ARRAYS:
+            (path / f"{name}.npy").unlink(missing_ok=True)
+
+
+def allocate_grouped_expressions(path: Path, brain_region: np.ndarray, gene_id: np.ndarray,
+                                 offsets: np.ndarray) -> GroupedExpressions:
+    """
+        Writes the keys and offsets of a store and returns it with a writable memory-mapped values array to fill
+    """
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / "brain_region.npy", np.asarray(brain_region))
+    np.save(path / "gene_id.npy", np.asarray(gene_id))
+    np.save(path / "offsets.npy", np.asarray(offsets))
+    write_brain_region_index(GroupedExpressions(brain_region, gene_id, offsets, None), path)
+    values = np.lib.format.open_memmap(path / "values.npy", mode="w+", dtype=np.float32, shape=(int(offsets[-1]),))
+    return GroupedExpressions(brain_region=brain_region, gene_id=gene_id, offsets=offsets, values=values)
+
+
+def write_grouped_expressions_to_csv(store: GroupedExpressions, path: Path, chunk_pairs: int = 50000) -> None:
+    """
+        Writes the store as a legacy grouped csv with json encoded lists, chunk_pairs pairs at a time
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for start in range(0, max(len(store), 1), chunk_pairs):
+        stop = min(start + chunk_pairs, len(store))
+        offsets = np.asarray(store.offsets[start:stop + 1])
+        # Shortest float32 representations keep the csv as small as the raw data
+        values = np.asarray(store.values[offsets[0]:offsets[-1]]).astype(str)
+        chunk = pd.DataFrame({
+            "brain_region": np.asarray(store.brain_region[start:stop]),
+            "gene_id": np.asarray(store.gene_id[start:stop]),
+            "gene_expression_values": ["[" + ", ".join(values[begin:end]) + "]"
+                                       for begin, end in zip(offsets[:-1] - offsets[0], offsets[1:] - offsets[0])],
+        })
+        chunk.to_csv(path, index=False, mode="w" if start == 0 else "a", header=start == 0)
+
+
+def load_grouped_expressions(path: Path, mmap: bool = True) -> GroupedExpressions:
+    """
+        Loads the ragged store from a directory of .npy arrays, memory-mapped by default
+    """
+    if not path.is_dir():
+        raise FileNotFoundError(f"Grouped expressions store not found: {path}")
+    mmap_mode = "r" if mmap else None
+    arrays = {name: np.load(path / f"{name}.npy", mmap_mode=mmap_mode) for name in GROUPED_STORE_ARRAYS}
+    if (path / "donor.npy").exists():
+        arrays["donor"] = np.load(path / "donor.npy", mmap_mode=mmap_mode)
+    return GroupedExpressions(**arrays)
+
+
+def load_grouped_df(path: Path) -> pd.DataFrame:
+    """
+        Loads a grouped df with parsed gene_expression_values lists and a sample_count column,
+        from a store directory or from a legacy grouped csv
+    """
+    store = load_grouped_expressions(path) if path.is_dir() else grouped_expressions_from_df(load_df_from_csv(path))
+    return grouped_expressions_to_df(store, sample_count=True)
+
+
+def _segment_indices(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+        Concatenation of arange(start, start + length) over all segments
+    """
+    segment_starts = np.cumsum(lengths) - lengths
+    return np.repeat(starts - segment_starts, lengths) + np.arange(lengths.sum())
+
+
+def merge_grouped_expressions(stores: List[GroupedExpressions], donor_ids: List[int],
+                              brain_regions: Optional[np.ndarray] = None,
+                              out_path: Optional[Path] = None) -> GroupedExpressions:
+    """
+        Merges the stores of several donors into one store grouped by Brain Region-Gene Id pair.
+        The values of each pair are concatenated in donor order, the donor of every value is recorded.
+        If brain_regions is given only those brain regions are kept.
+        If out_path is given the merged store is written there directly, its values and donors memory-mapped
+        instead of held in memory.
+    """
+    # Table of the kept pairs of all donors
+    keep = [np.ones(len(store), dtype=bool) if brain_regions is None else np.isin(store.brain_region, brain_regions)
+            for store in stores]
+    pair_br = np.concatenate([np.asarray(store.brain_region)[k] for store, k in zip(stores, keep)])
+    pair_ge = np.concatenate([np.asarray(store.gene_id)[k] for store, k in zip(stores, keep)])
+    pair_counts = np.concatenate([store.sample_counts[k] for store, k in zip(stores, keep)])
+    pair_source = np.concatenate([np.full(k.sum(), i) for i, k in enumerate(keep)])
+    pair_starts = np.concatenate([np.asarray(store.offsets[:-1])[k] for store, k in zip(stores, keep)])
+
+    # Stable sort by key keeps the donor order within every pair
+    order = np.lexsort((pair_ge, pair_br))
+    destination_starts = np.empty(len(order), dtype=np.int64)
+    destination_starts[order] = np.cumsum(pair_counts[order]) - pair_counts[order]
+
+    # Merged pairs start where the sorted key changes
+    sorted_br, sorted_ge = pair_br[order], pair_ge[order]
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = (sorted_br[1:] != sorted_br[:-1]) | (sorted_ge[1:] != sorted_ge[:-1])
+    n_values = int(pair_counts.sum())
+    offsets = np.append(destination_starts[order][is_first], n_values).astype(np.int64)
+
+    # Gather the values of every donor into their merged positions at once
+    if out_path is None:
+        values = np.empty(n_values, dtype=np.float32)
+        donor = np.empty(n_values, dtype=np.int32)
+    else:
+        values = allocate_grouped_expressions(out_path, sorted_br[is_first], sorted_ge[is_first], offsets).values
+        donor = np.lib.format.open_memmap(out_path / "donor.npy", mode="w+", dtype=np.int32, shape=(n_values,))
+    for i, (store, donor_id) in enumerate(zip(stores, donor_ids)):
+        source = pair_source == i
+        destination_index = _segment_indices(destination_starts[source], pair_counts[source])
+        source_index = _segment_indices(pair_starts[source], pair_counts[source])
+        values[destination_index] = np.asarray(store.values)[source_index]
+        donor[destination_index] = donor_id if store.donor is None else np.asarray(store.donor)[source_index]
+    if out_path is not None:
+        values.flush()
+        donor.flush()
+
+    return GroupedExpressions(brain_region=sorted_br[is_first], gene_id=sorted_ge[is_first],
+                              offsets=offsets, values=values, donor=donor)
+
+
+
+# Brain region index of a store, to read the genes of one region without touching the others
+def is_sorted_by_brain_region(store: GroupedExpressions) -> bool:
+    """
+        Whether the pairs of a store are sorted by brain region
+    """
+    brain_region = np.asarray(store.brain_region)
+    return not np.any(brain_region[1:] < brain_region[:-1])
+
+
+def write_brain_region_index(store: GroupedExpressions, path: Path) -> None:
+    """
+        Writes regions.npy and region_offsets.npy into a store sorted by brain region.
+        The pairs of region i are the pairs region_offsets[i]:region_offsets[i + 1].
+    """
+    if not is_sorted_by_brain_region(store):
+        raise ValueError(f"Store is not sorted by brain region: {path}")
+    brain_region = np.asarray(store.brain_region)
+    regions, region_starts = np.unique(brain_region, return_index=True)
+    np.save(path / "regions.npy", regions)
+    np.save(path / "region_offsets.npy", np.append(region_starts, len(brain_region)).astype(np.int64))
+
+
+def load_brain_region(path: Path, region: int) -> pd.DataFrame:
+    """
+        Loads the gene ids and gene expression values of one brain region of an indexed store
+    """
+    regions = np.load(path / "regions.npy")
+    region_offsets = np.load(path / "region_offsets.npy")
+    position = np.searchsorted(regions, region)
+    if position == len(regions) or regions[position] != region:
+        raise KeyError(f"Brain region not found: {region}")
+
+    # Only the slices of the region are read from the memory-mapped arrays
+    first_pair, last_pair = region_offsets[position], region_offsets[position + 1]
+    offsets = np.load(path / "offsets.npy", mmap_mode="r")[first_pair:last_pair + 1]
+    values = np.asarray(np.load(path / "values.npy", mmap_mode="r")[offsets[0]:offsets[-1]])
+    return pd.DataFrame({
+        "gene_id": np.asarray(np.load(path / "gene_id.npy", mmap_mode="r")[first_pair:last_pair]),
+        "gene_expression_values": [values[start:end] for start, end in zip(offsets[:-1] - offsets[0], offsets[1:] - offsets[0])],
+    })
+
+
+def iter_brain_regions_store(path: Path, brain_regions: Optional[Iterable[int]] = None) -> Iterator[Tuple[int, pd.DataFrame]]:
+    """
+        Lazily yields (brain_region, df of gene_id and gene_expression_values) of an indexed store
+    """
+    regions = np.load(path / "regions.npy") if brain_regions is None else brain_regions
+    for region in regions:
+        yield int(region), load_brain_region(path, region)
+
+
+# Streaming access to the hierarchical {brain_region: [{gene_id, gene_expression_values}]} json files
+def iter_gene_records_json(path: Path, brain_regions: Optional[Iterable[int]] = None,
+                           gene_ids: Optional[Iterable[int]] = None) -> Iterator[Tuple[int, int, List[float]]]:
+    """
+        Lazily yields (brain_region, gene_id, gene_expression_values) records of a json file, optionally filtered.
+        Only the records that pass the filters are built in memory.
+    """
+    brain_regions = None if brain_regions is None else {int(br) for br in brain_regions}
+    gene_ids = None if gene_ids is None else {int(ge) for ge in gene_ids}
+
+    # ijson is only needed by the json hierarchical format
+    import ijson
+    with open(path, "rb") as f:
+        region, record_prefix, keep_region = None, None, False
+        builder, skipping = None, False
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix == "" and event == "map_key":
+                # A new brain region starts
+                region = int(value)
+                record_prefix = f"{value}.item"
+                keep_region = brain_regions is None or region in brain_regions
+            elif not keep_region or prefix == "" or not prefix.startswith(record_prefix):
+                continue
+            elif prefix == record_prefix and event == "start_map":
+                builder, skipping = ijson.ObjectBuilder(), False
+                builder.event(event, value)
+            elif prefix == record_prefix and event == "end_map":
+                if not skipping:
+                    builder.event(event, value)
+                    record = builder.value
+                    yield region, int(record["gene_id"]), record["gene_expression_values"]
+                builder, skipping = None, False
+            elif builder is not None and not skipping:
+                # Skip the values of genes that are filtered out as soon as the gene id is known
+                if gene_ids is not None and prefix == f"{record_prefix}.gene_id" and int(value) not in gene_ids:
+                    skipping = True
+                    continue
+                builder.event(event, value)
+
+
+def iter_brain_regions_json(path: Path, brain_regions: Optional[Iterable[int]] = None,
+                            gene_ids: Optional[Iterable[int]] = None) -> Iterator[Tuple[int, pd.DataFrame]]:
+    """
+        Lazily yields (brain_region, df of gene_id and gene_expression_values) of a json file, optionally filtered
+    """
+    for region, records in groupby(iter_gene_records_json(path, brain_regions, gene_ids), key=lambda record: record[0]):
+        records = list(records)
+        yield region, pd.DataFrame({"gene_id": [record[1] for record in records],
+                                    "gene_expression_values": [record[2] for record in records]})
+
+
+def write_grouped_expressions_to_json(store: GroupedExpressions, path: Path, indent: Optional[int] = None) -> None:
+    """
+        Streams the store into the hierarchical json structure one Brain Region-Gene Id pair at a time
+    """
+    # Separators laid out like json.dump with the same indent
+    if indent is None:
+        newline, pad = "", ""
+        item_separator, key_separator = ", ", ": "
+    else:
+        newline, pad = "\n", " " * indent
+        item_separator, key_separator = ",", ": "
+
+    def line(level: int) -> str:
+        return newline + pad * level
+
+    brain_region = np.asarray(store.brain_region)
+    order = np.argsort(brain_region, kind="stable")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        f.write("{")
+        region = None
+        for n, i in enumerate(order):
+            if brain_region[i] != region:
+                # Close the previous brain region and open the next one
+                if region is not None:
+                    f.write(line(1) + "]" + item_separator)
+                region = brain_region[i]
+                f.write(line(1) + json.dumps(str(int(region))) + key_separator + "[")
+            elif n:
+                f.write(item_separator)
+            values = np.asarray(store.get_values(i)).astype(str)
+            values_separator = item_separator + line(4)
+            f.write(line(2) + "{"
+                    + line(3) + '"gene_id"' + key_separator + str(int(store.gene_id[i])) + item_separator
+                    + line(3) + '"gene_expression_values"' + key_separator + "["
+                    + (line(4) + values_separator.join(values) + line(3) if len(values) else "") + "]"
+                    + line(2) + "}")
+        if region is not None:
+            f.write(line(1) + "]")
+        f.write(line(0) + "}" if region is not None else "}")
@@ -0,0 +1,187 @@
+import io
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+from fnmatch import fnmatch
+from pathlib import Path
+from datetime import datetime
+from functools import wraps
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+from src.utils.memory_management import MB, MemoryBudget, track_memory
+from src.utils.logger import get_logger
+from src.configs.config_parser import get_config, project_root
+
+# Configs Directory
+parser = get_config()
+
+# Set up logger
+logger = get_logger(__name__)
+
+RUN_REPORTS_PATH = project_root / parser.get("output_paths", {}).get("run_reports", "results/run_reports")
+# Stage name patterns (fnmatch) run under cProfile and tracemalloc, None for no stage
+PROFILE_STAGE = parser.get("instrumentation", {}).get("profile_stage")
+TRACEMALLOC_STAGE = parser.get("instrumentation", {}).get("tracemalloc_stage")
+# Number of functions of a cProfile run kept in the run report
+PROFILE_TOP_FUNCTIONS = 25
+
+
+@dataclass
+class StageRecord:
+    """
+        Measurements of one stage of a run
+    """
+    name: str
+    parent: Optional[str] = None
+    started_at: str = ""
+    wall_time_s: float = 0.0
+    cpu_time_s: float = 0.0
+    rows: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    peak_rss_mb: float = 0.0
+    rss_growth_mb: float = 0.0
+    frames_mb: Dict[str, float] = field(default_factory=dict)
+    tracemalloc_peak_mb: Optional[float] = None
+    profile: Optional[str] = None
+    error: Optional[str] = None
+
+    def add_rows(self, rows: int) -> None:
+        self.rows += int(rows)
+
+    def add_bytes_read(self, paths: Union[Path, Iterable[Path]]) -> None:
+        self.bytes_read += get_size(paths)
+
+    def add_bytes_written(self, paths: Union[Path, Iterable[Path]]) -> None:
+        self.bytes_written += get_size(paths)
+
+
+@dataclass
+class RunReport:
+    """
+        Stage records of a run, written as json into the run reports directory
+    """
+    name: str
+    started_at: str = field(default_factory=lambda: datetime.now().isoformat(timespec="seconds"))
+    stages: List[StageRecord] = field(default_factory=list)
+
+    def write(self, output_path: Path = RUN_REPORTS_PATH) -> Path:
+        output_path.mkdir(parents=True, exist_ok=True)
+        path = output_path / f"{self.name}_{self.started_at.replace(':', '-')}.json"
+        path.write_text(json.dumps(asdict(self), indent=4))
+        return path
+
+
+# Report of the running entry point and the stack of the open stages
+_run_report: Optional[RunReport] = None
+_open_stages: List[StageRecord] = []
+
+
+def get_size(paths: Union[Path, Iterable[Path]]) -> int:
+    """
+        Size in bytes of files, or of every file of directories, missing paths count 0
+    """
+    paths = [paths] if isinstance(paths, (str, Path)) else paths
+    size = 0
+    for path in map(Path, paths):
+        if path.is_dir():
+            size += sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+        elif path.is_file():
+            size += path.stat().st_size
+    return size
+
+
+@contextmanager
+def run_report(name: str, output_path: Path = RUN_REPORTS_PATH) -> Iterator[RunReport]:
+    """
+        Collects the stages run inside the block and writes them as a json run report on exit
+    """
+    global _run_report
+    previous, _run_report = _run_report, RunReport(name)
+    try:
+        with stage(name):
+            yield _run_report
+    finally:
+        report, _run_report = _run_report, previous
+        logger.info(f"Run report written to {report.write(output_path)}")
+
+
+@contextmanager
+def stage(name: str, budget: Optional[MemoryBudget] = None,
+          profile: Optional[bool] = None, trace_memory: Optional[bool] = None) -> Iterator[StageRecord]:
+    """
+        Records the wall time, CPU time and peak RSS of a stage, rows and bytes are added to the yielded record.
+        The stage runs under cProfile / tracemalloc if profile / trace_memory is set, or if its name matches the
+        configured instrumentation.profile_stage / tracemalloc_stage patterns.
+        The record is added to the active run report.
+    """
+    record = StageRecord(name, parent=_open_stages[-1].name if _open_stages else None,
+                         started_at=datetime.now().isoformat(timespec="seconds"))
+    profile = profile if profile is not None else bool(PROFILE_STAGE and fnmatch(name, PROFILE_STAGE))
+    trace_memory = trace_memory if trace_memory is not None else bool(TRACEMALLOC_STAGE and fnmatch(name, TRACEMALLOC_STAGE))
+    profiler = cProfile.Profile() if profile else None
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    elif trace_memory and hasattr(tracemalloc, "reset_peak"):
+        # reset_peak needs Python 3.9, on 3.8 a nested stage reports the peak of the enclosing traced stage
+        tracemalloc.reset_peak()
+
+    _open_stages.append(record)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        with track_memory(name, budget, log=False) as memory:
+            # Frames recorded by the stage with record.memory.track_df end up in the report
+            record.memory = memory
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield record
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+    except BaseException as e:
+        record.error = repr(e)
+        raise
+    finally:
+        _open_stages.pop()
+        record.wall_time_s = time.perf_counter() - start_wall
+        record.cpu_time_s = time.process_time() - start_cpu
+        record.peak_rss_mb = memory.peak_rss / MB
+        record.rss_growth_mb = (memory.peak_rss - memory.start_rss) / MB
+        record.frames_mb = {frame: nbytes / MB for frame, nbytes in memory.frames.items()}
+        if trace_memory:
+            record.tracemalloc_peak_mb = tracemalloc.get_traced_memory()[1] / MB
+            if started_tracing:
+                tracemalloc.stop()
+        if profiler is not None:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            record.profile = stream.getvalue()
+        if _run_report is not None:
+            _run_report.stages.append(record)
+        logger.info(f"{name}: {record.wall_time_s:.2f}s wall, {record.cpu_time_s:.2f}s CPU, {record.rows} rows, "
+                    f"{record.bytes_read / MB:.1f} MB read, {record.bytes_written / MB:.1f} MB written, "
+                    f"peak RSS {record.peak_rss_mb:.1f} MB (+{record.rss_growth_mb:.1f} MB)")
+
+
+def instrumented(name: Optional[str] = None, rows: Optional[Callable] = len) -> Callable:
+    """
+        Decorator running a function as a stage, its rows are rows(result) (the length of the result by default)
+    """
+    def decorator(function: Callable) -> Callable:
+        stage_name = name or f"{function.__module__.split('.')[-1]}/{function.__name__}"
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name) as record:
+                result = function(*args, **kwargs)
+                if rows is not None and result is not None:
+                    record.add_rows(rows(result))
+                return result
+        return wrapper
+    return decorator
@@ -0,0 +1,18 @@
+import logging
+
+
+def get_logger(name: str, level: int = logging.INFO) -> logging.Logger:
+    """
+        Logger of a module with a console handler.
+        The handler is only added once, so reloading or re-importing a module does not duplicate its log lines.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    if not any(getattr(handler, "_console_handler", False) for handler in logger.handlers):
+        # Create a console handler
+        sh = logging.StreamHandler()
+        sh.setLevel(level)
+        sh._console_handler = True
+        # Add the handler to the logger
+        logger.addHandler(sh)
+    return logger
@@ -1,10 +1,197 @@
 import gc
+import os
+import sys
+import time
+import resource
+import threading
 import pandas as pd
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Optional
 
+from src.utils.logger import get_logger
 
-def deallocate_df(df: pd.DataFrame) -> None:
-        # df is your DataFrame
-        del df  # Removes the reference to df
+# Set up logger
+logger = get_logger(__name__)
+
+__all__ = ["MB", "GB", "MIN_CHUNK_FRACTION", "get_rss", "get_peak_rss", "df_memory", "MemoryBudget", "StageMemory", "track_memory",
+           "FrameScope", "released_frames", "deallocate_df"]
+
+MB = 1 << 20
+GB = 1 << 30
+# Seconds between two RSS samples while a stage is tracked
+SAMPLING_INTERVAL = 0.05
+# Smallest fraction of the requested chunk size a memory budget shrinks chunks to
+MIN_CHUNK_FRACTION = 0.125
+
+
+def get_rss() -> int:
+    """
+        Current resident set size of the process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # No procfs, fall back to the peak resident set size
+        return get_peak_rss()
+
+
+def get_peak_rss() -> int:
+    """
+        Peak resident set size of the process since it started in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def df_memory(df: pd.DataFrame) -> int:
+    """
+        Memory held by a DataFrame in bytes, including the contents of object and string columns
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+
+class MemoryBudget:
+    """
+        Memory budget of the process in bytes, None for no limit.
+        Stages ask the budget how large their chunks can be and whether their outputs must be spilled to disk.
+    """
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+        self._last_chunk_size = None
+
+    @classmethod
+    def from_gb(cls, limit_gb: Optional[float]) -> "MemoryBudget":
+        return cls(None if limit_gb is None else int(limit_gb * GB))
+
+    def available(self) -> Optional[int]:
+        """
+            Bytes left before reaching the limit
+        """
+        return None if self.limit is None else max(self.limit - get_rss(), 0)
+
+    def exceeded(self) -> bool:
+        return self.limit is not None and get_rss() > self.limit
+
+    def fits(self, nbytes: int) -> bool:
+        """
+            Whether nbytes more can be held in memory without exceeding the limit
+        """
+        available = self.available()
+        return available is None or nbytes <= available
+
+    def check(self, stage: str) -> bool:
+        """
+            Logs a warning if the process already exceeds the budget before a stage starts, returns whether it does.
+            The budget covers the whole process, so a caller holding large frames (e.g. a notebook kernel) uses it up.
+        """
+        if not self.exceeded():
+            return False
+        logger.warning(f"{stage}: RSS {get_rss() / MB:.1f} MB already exceeds the memory budget of "
+                       f"{self.limit / MB:.1f} MB, chunks are kept at their minimum size")
+        return True
 
-        # Force garbage collection to free up memory
+    def fit_chunk_size(self, chunk_size: int, row_bytes: int, min_chunk_size: Optional[int] = None) -> int:
+        """
+            Shrinks chunk_size so that a chunk of rows of row_bytes each fits in the memory left,
+            down to min_chunk_size rows (MIN_CHUNK_FRACTION of chunk_size by default)
+        """
+        available = self.available()
+        if available is None or chunk_size * row_bytes <= available:
+            return chunk_size
+        if min_chunk_size is None:
+            min_chunk_size = max(int(chunk_size * MIN_CHUNK_FRACTION), 1)
+        fitted = max(int(available // max(row_bytes, 1)), min_chunk_size)
+        if fitted != self._last_chunk_size:
+            logger.info(f"Memory budget: shrinking chunk size from {chunk_size} to {fitted} rows")
+            self._last_chunk_size = fitted
+        return fitted
+
+
+@dataclass
+class StageMemory:
+    """
+        Memory of a tracked stage, in bytes
+    """
+    stage: str
+    start_rss: int = 0
+    end_rss: int = 0
+    peak_rss: int = 0
+    frames: Dict[str, int] = field(default_factory=dict)
+
+    def track_df(self, name: str, df: pd.DataFrame) -> pd.DataFrame:
+        """
+            Records the memory of an intermediate DataFrame of the stage and returns it
+        """
+        self.frames[name] = df_memory(df)
+        return df
+
+
+@contextmanager
+def track_memory(stage: str, budget: Optional[MemoryBudget] = None,
+                 interval: float = SAMPLING_INTERVAL, log: bool = True) -> Iterator[StageMemory]:
+    """
+        Tracks the RSS of a stage, sampled in a background thread to catch its peak, and logs it on exit if log is set.
+        Logs a warning if the peak exceeded the budget.
+    """
+    memory = StageMemory(stage, start_rss=get_rss())
+    memory.peak_rss = memory.start_rss
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            memory.peak_rss = max(memory.peak_rss, get_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        yield memory
+    finally:
+        done.set()
+        sampler.join()
+        memory.end_rss = get_rss()
+        memory.peak_rss = max(memory.peak_rss, memory.end_rss)
+        frames = "".join(f", {name}: {nbytes / MB:.1f} MB" for name, nbytes in memory.frames.items())
+        if log:
+            logger.info(f"{stage}: peak RSS {memory.peak_rss / MB:.1f} MB (start {memory.start_rss / MB:.1f} MB, "
+                        f"end {memory.end_rss / MB:.1f} MB) in {time.perf_counter() - start:.1f}s{frames}")
+        if budget is not None and budget.limit is not None and memory.peak_rss > budget.limit:
+            logger.warning(f"{stage}: peak RSS {memory.peak_rss / MB:.1f} MB exceeded the memory budget "
+                           f"of {budget.limit / MB:.1f} MB")
+
+
+class FrameScope(dict):
+    """
+        Owner of the intermediate frames of a block, see released_frames
+    """
+
+
+@contextmanager
+def released_frames() -> Iterator[FrameScope]:
+    """
+        Holds the intermediate frames of a block and releases them on exit.
+        The frames are only freed if the block keeps no other reference to them, so access them through the scope:
+
+            with released_frames() as frames:
+                frames["donor_sa"] = load_df_from_csv(path)
+                result = frames["donor_sa"]["structure_id"].unique()
+    """
+    frames = FrameScope()
+    try:
+        yield frames
+    finally:
+        frames.clear()
+        # Frames without reference cycles are freed by the clear, collect the cycles once per block
         gc.collect()
+
+
+def deallocate_df(df: pd.DataFrame) -> None:
+    """
+        Deprecated, use released_frames to release the intermediate frames of a block.
+        Only runs the garbage collector: the frame is left untouched, as the caller may still use it,
+        and its memory is freed once the caller drops its own references.
+    """
+    gc.collect()
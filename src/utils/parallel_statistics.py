@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from src.utils.statistics_utils import GeneH0Index, calculate_batch_statistics, write_stats_per_sample_size
+from src.utils.instrumentation import instrumented
+from src.utils.logger import get_logger
+from src.configs.config_parser import get_config
+
+# Configs Directory
+parser = get_config()
+
+# Set up logger
+logger = get_logger(__name__)
+
+MAX_WORKERS = parser.get("statistics", {}).get("max_workers")
+SHARD_SIZE = parser.get("statistics", {}).get("shard_size", 2000)
+
+H0_COLUMNS = ["gene_id", "weighted_mean", "std", "total_sample_count"]
+
+# Shared inputs of a worker process, attached once by the pool initializer
+_worker_blocks: List[shared_memory.SharedMemory] = []
+_worker_inputs: Dict = {}
+
+
+# Shared memory helpers
+def _to_shared_memory(array: np.ndarray) -> Tuple[shared_memory.SharedMemory, Tuple]:
+    """
+        Copies an array into a new shared memory block and returns the block and its (name, shape, dtype) spec
+    """
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _attach_shared_array(spec: Tuple) -> np.ndarray:
+    """
+        Attaches to a shared memory block of a worker and returns a read-only array view
+    """
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    _worker_blocks.append(block)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    array.flags.writeable = False
+    return array
+
+
+def _init_worker(specs: Dict[str, Tuple], params: Dict) -> None:
+    """
+        Pool initializer attaching the shared samples, pair keys and gene H0 table
+    """
+    arrays = {key: _attach_shared_array(spec) for key, spec in specs.items()}
+    _worker_inputs["samples"] = arrays.pop("samples")
+    _worker_inputs["brain_region"] = arrays.pop("brain_region")
+    _worker_inputs["gene_id"] = arrays.pop("gene_id")
+    _worker_inputs["geneid_H0"] = GeneH0Index(pd.DataFrame({column: arrays[f"H0_{column}"] for column in H0_COLUMNS}))
+    _worker_inputs["params"] = params
+
+
+def _run_shard(shard: Tuple[int, int]) -> pd.DataFrame:
+    """
+        Calculates the statistics of the pairs [start, stop) in a worker
+    """
+    start, stop = shard
+    return calculate_batch_statistics(_worker_inputs["samples"][start:stop],
+                                      _worker_inputs["brain_region"][start:stop],
+                                      _worker_inputs["gene_id"][start:stop],
+                                      _worker_inputs["geneid_H0"],
+                                      **_worker_inputs["params"])
+
+
+# Parallel sweep over Brain Region-Gene Id pairs
+@instrumented()
+def run_parallel_statistics(samples: np.ndarray, brain_regions: np.ndarray, gene_ids: np.ndarray,
+                            geneid_H0: pd.DataFrame, sample_sizes: List[int], alpha: float = 0.05,
+                            p_value_method: str = "wilcoxon", B: int = 1000, seed: int = 42,
+                            power_table: bool = False, max_workers: Optional[int] = MAX_WORKERS, shard_size: int = SHARD_SIZE,
+                            output_path: Optional[Path] = None) -> pd.DataFrame:
+    """
+        Shards the pairs across a process pool and calculates the statistics of every sample size.
+        Inputs are shared with the workers through shared memory, only shard bounds are sent per task.
+        Every pair's statistics are independent of the other pairs of its shard (wilcoxon tests tied and untied rows
+        apart, bootstrap index matrices only depend on (seed, sample_size)), so results match the serial run.
+        If output_path is given, the <sample_size>_stats.csv files are written there.
+    """
+    samples = np.asarray(samples)
+    shards = [(start, min(start + shard_size, len(samples))) for start in range(0, len(samples), shard_size)]
+    params = {"sample_sizes": list(sample_sizes), "alpha": alpha, "p_value_method": p_value_method, "B": B, "seed": seed,
+              "power_table": power_table}
+
+    shared = {"samples": samples, "brain_region": np.asarray(brain_regions), "gene_id": np.asarray(gene_ids)}
+    shared.update({f"H0_{column}": geneid_H0[column].to_numpy() for column in H0_COLUMNS})
+
+    blocks, specs = [], {}
+    try:
+        for key, array in shared.items():
+            block, specs[key] = _to_shared_memory(array)
+            blocks.append(block)
+
+        logger.info(f"Processing {len(samples)} pairs in {len(shards)} shards")
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(specs, params)) as executor:
+            stats_df = pd.concat(executor.map(_run_shard, shards), ignore_index=True)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    if output_path is not None:
+        write_stats_per_sample_size(stats_df, sample_sizes, output_path)
+
+    return stats_df
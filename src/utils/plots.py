@@ -1,33 +1,27 @@
+import io
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 from matplotlib import ticker
 
-from typing import List
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+from functools import lru_cache
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
-from src.configs.config_parser import PathConfigParser, data_config_file, project_root
-
-from matplotlib.patches import Patch
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
-from scipy.cluster.hierarchy import dendrogram, linkage
-
-
-from matplotlib.colors import LinearSegmentedColormap
-from nilearn import plotting
-from nilearn.image import new_img_like, smooth_img
-from nilearn.datasets import load_mni152_template
-import nibabel as nib
+from src.configs.config_parser import get_config, project_root
 
 
 # Configs Directory
-parser = PathConfigParser(str(data_config_file))
-parser.load()
+parser = get_config()
 
-# Path of Plots 
+# Path of Plots, created when the first plot is saved
 PLOTS_PTH = project_root / parser.get("output_paths", {}).get("plots")
-PLOTS_PTH.mkdir(parents=True, exist_ok=True)
+
+# Number of processes rendering animation frames, None for all cores
+MAX_WORKERS = parser.get("plots", {}).get("max_workers")
+# Radius in voxels of the sphere drawn around every sample of a cluster image
+SPHERE_RADIUS = 2
 
 
 # Define colors using a modern, muted color palette for clusters
@@ -74,6 +68,7 @@ def plot_values(x: List[int], y: List[int], plot_title: str= "Values per Label",
 
     # Save if necessary
     if save:
+        PLOTS_PTH.mkdir(parents=True, exist_ok=True)
         fig.savefig(PLOTS_PTH / Path(f"{plot_title}.png"), dpi=300, bbox_inches='tight')
 
     # Show plot
@@ -120,6 +115,7 @@ def plot_histogram(values: List[int], plot_title: str= "Values per Label", x_tit
 
     # Save if necessary
     if save:
+        PLOTS_PTH.mkdir(parents=True, exist_ok=True)
         fig.savefig(PLOTS_PTH / Path(f"{plot_title}.png"), dpi=300, bbox_inches='tight')
 
     # Show plot
@@ -168,10 +164,6 @@ def plot_scatter_log(x: List[int], y: List[int], plot_title: str = "Values per L
     plt.show()
     
     
-import matplotlib.pyplot as plt
-import numpy as np
-from typing import List
-
 def plot_multiple_scatter_log(x: List[int], y_lists: List[List[int]], threshold: int = -1, plot_title: str = "Values per Label", 
                      x_title: str = "Labels", y_title: str = "Values", labels: List[str] = None, 
                      save: bool = False) -> None:
@@ -248,51 +240,156 @@ def plot_multiple_scatter_log(x: List[int], y_lists: List[List[int]], threshold:
     
     
     
+@lru_cache(maxsize=None)
+def get_mni_template() -> Tuple:
+    """
+        MNI152 template and its inverse affine (MNI mm to voxel indices), loaded once per process
+    """
+    from nilearn.datasets import load_mni152_template
+
+    template = load_mni152_template()
+    return template, np.linalg.inv(template.affine)
+
+
+@lru_cache(maxsize=None)
+def get_sphere_offsets(radius: int = SPHERE_RADIUS) -> np.ndarray:
+    """
+        Voxel offsets (n x 3) of a sphere of radius voxels around its center
+    """
+    grid = np.mgrid[-radius:radius + 1, -radius:radius + 1, -radius:radius + 1].reshape(3, -1).T
+    return grid[(grid ** 2).sum(axis=1) <= radius ** 2]
+
+
+def voxelize_coordinates(coords: np.ndarray, values: np.ndarray, shape: Tuple[int, int, int],
+                         inverse_affine: np.ndarray, radius: int = SPHERE_RADIUS) -> np.ndarray:
+    """
+        Volume of shape with a sphere stamped around every MNI coordinate, holding the value of its coordinate.
+        All coordinates are mapped to voxels in one matrix product, coordinates outside the volume are dropped and
+        spheres are cut at its border. Overlapping spheres keep the largest value, voxels without a sphere are 0.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    values = np.broadcast_to(np.asarray(values, dtype=float), len(coords))
+    voxels = np.rint(coords @ inverse_affine[:3, :3].T + inverse_affine[:3, 3]).astype(np.int64)
+    inside = np.all((voxels >= 0) & (voxels < shape), axis=1)
+    voxels, values = voxels[inside], values[inside]
+
+    # Every sphere voxel of every coordinate, without the voxels outside the volume
+    offsets = get_sphere_offsets(radius)
+    stamped = (voxels[:, None, :] + offsets[None, :, :]).reshape(-1, 3)
+    stamped_values = np.repeat(values, len(offsets))
+    inside = np.all((stamped >= 0) & (stamped < shape), axis=1)
+    data = np.full(shape, -np.inf)
+    np.maximum.at(data, tuple(stamped[inside].T), stamped_values[inside])
+    data[np.isneginf(data)] = 0
+    return data
+
+
+def create_cluster_images(clusters: Sequence, color_values: Sequence[float], fwhm: float = 6,
+                          radius: int = SPHERE_RADIUS) -> List:
+    """
+        Smoothed 3D images of several clusters (DataFrames with mni_x, mni_y, mni_z columns), one per color value.
+        The clusters are voxelized into one 4D volume, smoothed in a single pass and split into 3D images.
+    """
+    from nilearn.image import iter_img, new_img_like, smooth_img
+
+    template, inverse_affine = get_mni_template()
+    data = np.stack([voxelize_coordinates(cluster[['mni_x', 'mni_y', 'mni_z']].to_numpy(), color_value,
+                                          template.shape[:3], inverse_affine, radius)
+                     for cluster, color_value in zip(clusters, color_values)], axis=-1)
+
+    # Create the image of all clusters and apply smoothing
+    smoothed_img = smooth_img(new_img_like(template, data, affine=template.affine), fwhm=fwhm)
+    return list(iter_img(smoothed_img))
+
+
 def create_cluster_image(cluster_data, color_value, fwhm=6):
     """Create a smoothed 3D image for a single cluster"""
-    # Merge with the expanded coordinates
-    # cluster_data = cluster.merge(all_coordinates_expanded, 
-    #                            left_on='brain_region', 
-    #                            right_on='structure_id')
-    
-    # Use the _y coordinates (from all_coordinates_expanded)
-    coords = cluster_data[['mni_x', 'mni_y', 'mni_z']].values
-    
-    # Load template and get affine transformation
-    template = load_mni152_template()
-    affine = template.affine
-    
-    # Initialize empty volume
-    data = np.zeros(template.shape)
-    
-    # Create a sphere for each coordinate
-    for x, y, z in coords:
-        # Convert MNI coordinates to voxel coordinates
-        vox_coords = nib.affines.apply_affine(np.linalg.inv(affine), 
-                                            np.array([[x, y, z]]))
-        vox_coords = np.round(vox_coords[0]).astype(int)
-        
-        # Ensure coordinates are within bounds
-        if (0 <= vox_coords[0] < data.shape[0] and 
-            0 <= vox_coords[1] < data.shape[1] and 
-            0 <= vox_coords[2] < data.shape[2]):
-            
-            # Create a small sphere around the point
-            xx, yy, zz = np.ogrid[-2:3, -2:3, -2:3]
-            sphere = (xx**2 + yy**2 + zz**2 <= 2**2)
-            
-            # Get coordinates for the sphere
-            x_coords = np.clip(vox_coords[0] + xx, 0, data.shape[0]-1)
-            y_coords = np.clip(vox_coords[1] + yy, 0, data.shape[1]-1)
-            z_coords = np.clip(vox_coords[2] + zz, 0, data.shape[2]-1)
-            
-            # Set the sphere value
-            data[x_coords, y_coords, z_coords] = np.where(sphere, color_value, data[x_coords, y_coords, z_coords])
-    
-    # Create image
-    img = new_img_like(template, data, affine=affine)
-    
-    # Apply smoothing
-    smoothed_img = smooth_img(img, fwhm=fwhm)
-    
-    return smoothed_img
+    return create_cluster_images([cluster_data], [color_value], fwhm)[0]
+
+
+def _init_frame_worker() -> None:
+    """
+        Pool initializer rendering the frames of a worker headlessly
+    """
+    plt.switch_backend("Agg")
+
+
+def render_frame(draw_frame: Callable, frame, dpi: int = 100, bbox_inches: Optional[str] = None) -> bytes:
+    """
+        Draws a frame with draw_frame(frame) and returns the current figure as png bytes, without touching the disk.
+        draw_frame draws into a new figure (plt.subplots, nilearn plotting, ...), the figures it opens are closed afterwards.
+    """
+    open_figures = set(plt.get_fignums())
+    try:
+        draw_frame(frame)
+        buffer = io.BytesIO()
+        plt.gcf().savefig(buffer, format="png", dpi=dpi, bbox_inches=bbox_inches)
+        return buffer.getvalue()
+    finally:
+        for number in set(plt.get_fignums()) - open_figures:
+            plt.close(number)
+
+
+def _fit_frame(image: np.ndarray, shape: tuple) -> np.ndarray:
+    """
+        Crops or pads (white) an image to the height and width of the first frame, as the writers need one frame size
+    """
+    if image.shape[:2] == shape[:2]:
+        return image
+    fitted = np.full(shape[:2] + image.shape[2:], 255, dtype=image.dtype)
+    height, width = min(image.shape[0], shape[0]), min(image.shape[1], shape[1])
+    fitted[:height, :width] = image[:height, :width]
+    return fitted
+
+
+def render_frames(draw_frame: Callable, frames: Iterable, max_workers: Optional[int] = MAX_WORKERS,
+                  dpi: int = 100, bbox_inches: Optional[str] = None) -> Iterator[np.ndarray]:
+    """
+        Renders draw_frame(frame) for every frame in a process pool and yields the RGB images in the order of frames.
+        draw_frame must be picklable (a module level function, functools.partial to bind further arguments).
+        max_workers=1 renders in the current process.
+    """
+    import imageio.v2 as imageio
+
+    frames = list(frames)
+    executor, jobs = None, []
+    if max_workers == 1 or len(frames) <= 1:
+        rendered = (render_frame(draw_frame, frame, dpi, bbox_inches) for frame in frames)
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_frame_worker)
+        jobs = [executor.submit(render_frame, draw_frame, frame, dpi, bbox_inches) for frame in frames]
+        rendered = (job.result() for job in jobs)
+    try:
+        shape = None
+        for png in rendered:
+            # Frames are opaque, the alpha channel is dropped for the video writers
+            image = imageio.imread(io.BytesIO(png))[..., :3]
+            shape = shape or image.shape
+            yield _fit_frame(image, shape)
+    finally:
+        # Frames not rendered yet are dropped if the consumer stops early
+        for job in jobs:
+            job.cancel()
+        if executor is not None:
+            executor.shutdown()
+
+
+def save_animation(draw_frame: Callable, frames: Iterable, file_name: Union[str, Path], duration: float = 500,
+                   max_workers: Optional[int] = MAX_WORKERS, dpi: int = 100, bbox_inches: Optional[str] = None) -> Path:
+    """
+        Renders the frames in parallel (see render_frames) and streams them into a .gif or .mp4 (needs imageio-ffmpeg)
+        in the plots directory, duration is the display time of a frame in milliseconds. Returns the animation path.
+    """
+    import imageio.v2 as imageio
+
+    path = PLOTS_PTH / Path(file_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix == ".gif":
+        writer = imageio.get_writer(path, mode="I", duration=duration, loop=0)
+    else:
+        # Video writers take a frame rate, frames are padded to a size the codec supports
+        writer = imageio.get_writer(path, fps=1000 / duration, macro_block_size=16)
+    with writer:
+        for image in render_frames(draw_frame, frames, max_workers, dpi, bbox_inches):
+            writer.append_data(image)
+    return path
@@ -1,28 +1,18 @@
-import logging
-import ijson
 import numpy as np
 from decimal import Decimal
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 from src.utils.data import *
-from src.utils.plots import *
 from src.utils.memory_management import *
-from src.configs.config_parser import PathConfigParser, data_config_file
+from src.utils.logger import get_logger
+from src.configs.config_parser import get_config
 
 # Configs Directory
-parser = PathConfigParser(str(data_config_file))
-parser.load()
+parser = get_config()
 
 # Set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-# Create a console handler
-sh = logging.StreamHandler()
-sh.setLevel(logging.INFO)
-# Add the handler to the logger
-logger.addHandler(sh)
+logger = get_logger(__name__)
 
 
 PROCESSED_DATA_PATH = parser.get("data_paths", {}).get("processed_data")
@@ -71,8 +61,9 @@ def get_number_of_samples_per_br_ge(df:  pd.DataFrame) ->  List[int]:
     """
         Get the number of Samples per Brain Region-Gene Id pair.
     """
-    # Count the number of samples for each brain_region-gene_id pair
-    df["sample_count"] = df["gene_expression_values"].apply(len)
+    # Count the number of samples for each brain_region-gene_id pair, unless counted at load time
+    if "sample_count" not in df.columns:
+        df["sample_count"] = df["gene_expression_values"].apply(len)
     return df[["brain_region", "gene_id", "sample_count"]]
 
 
@@ -90,21 +81,181 @@ def get_ge_list(df:pd.DataFrame) -> List[int]:
     return df["gene_id"].unique().tolist()
 
 
+# Index of brain-region-gene-id pairs, built once for repeated and bulk lookups
+class PairIndex:
+    """
+        Sorted-key index over the Brain Region-Gene Id pairs of a df or grouped expressions store
+    """
+    def __init__(self, brain_regions: np.ndarray, gene_ids: np.ndarray):
+        keys = self._pair_keys(brain_regions, gene_ids)
+        self._order = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[self._order]
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame) -> "PairIndex":
+        return cls(df["brain_region"].to_numpy(), df["gene_id"].to_numpy())
+
+    @classmethod
+    def from_store(cls, store: GroupedExpressions) -> "PairIndex":
+        return cls(store.brain_region, store.gene_id)
+
+    @staticmethod
+    def _pair_keys(brain_regions: np.ndarray, gene_ids: np.ndarray) -> np.ndarray:
+        brain_regions = np.asarray(brain_regions, dtype=np.int64)
+        gene_ids = np.asarray(gene_ids, dtype=np.int64)
+        if brain_regions.size and (brain_regions.min() < 0 or gene_ids.min() < 0 or gene_ids.max() >= 2 ** 32
+                                   or brain_regions.max() >= 2 ** 31):
+            raise ValueError("Brain region and gene ids must be non-negative and fit in 31 and 32 bits")
+        return (brain_regions << 32) | gene_ids
+
+    def lookup(self, brain_regions: np.ndarray, gene_ids: np.ndarray) -> np.ndarray:
+        """
+            Row positions of the pairs, -1 for pairs not in the index
+        """
+        keys = self._pair_keys(np.atleast_1d(brain_regions), np.atleast_1d(gene_ids))
+        found = np.searchsorted(self._sorted_keys, keys).clip(max=max(len(self._sorted_keys) - 1, 0))
+        if not len(self._sorted_keys):
+            return np.full(len(keys), -1)
+        return np.where(self._sorted_keys[found] == keys, self._order[found], -1)
+
+    def position(self, br: int, ge: int) -> int:
+        """
+            Row position of a single pair
+        """
+        position = self.lookup(br, ge)[0]
+        if position < 0:
+            raise KeyError(f"Brain Region-Gene Id pair not found: ({br}, {ge})")
+        return int(position)
+
+
 # Sampling per brain-region-gene-id pair
-def get_br_ge_sample(df: pd.DataFrame, br: int, ge: int) -> List[int]:
+def get_br_ge_sample(df: pd.DataFrame, br: int, ge: int, index: Optional[PairIndex] = None) -> List[int]:
     """
-        Get the Samples of a Brain Region-Gene Id pair
+        Get the Samples of a Brain Region-Gene Id pair, using the pair index if given
     """
+    if index is not None:
+        return df["gene_expression_values"].iloc[index.position(br, ge)]
     return df[(df['brain_region'] == br) & (df['gene_id'] == ge)]["gene_expression_values"].to_list()[0]
 
+def get_br_ge_samples(store: GroupedExpressions, index: PairIndex, brs: np.ndarray, ges: np.ndarray) -> List[np.ndarray]:
+    """
+        Get the Samples of many Brain Region-Gene Id pairs of a grouped expressions store at once
+    """
+    positions = index.lookup(brs, ges)
+    if (positions < 0).any():
+        raise KeyError(f"{int((positions < 0).sum())} Brain Region-Gene Id pairs not found")
+    return [store.get_values(position) for position in positions]
+
+
+# Stacking the samples of all pairs into a dense (pairs x sample_size) matrix
+def get_samples_matrix(df: pd.DataFrame, sample_size: int) -> np.ndarray:
+    """
+        Get the first sample_size Samples of every Brain Region-Gene Id pair as a 2-D array
+    """
+    counts = df["gene_expression_values"].apply(len)
+    if (counts < sample_size).any():
+        raise ValueError(f"{int((counts < sample_size).sum())} pairs have fewer samples than sample_size: {sample_size}")
+    return np.array([sample[:sample_size] for sample in df["gene_expression_values"]], dtype=float)
+
+def get_store_samples_matrix(store: GroupedExpressions, sample_size: int) -> np.ndarray:
+    """
+        Get the first sample_size Samples of every pair in a grouped expressions store as a 2-D array
+    """
+    counts = store.sample_counts
+    if (counts < sample_size).any():
+        raise ValueError(f"{int((counts < sample_size).sum())} pairs have fewer samples than sample_size: {sample_size}")
+    return np.asarray(store.values)[store.offsets[:-1, None] + np.arange(sample_size)]
+
+
+# Reproducible fixed-size subsampling of every pair at once
+# Number of values ranked at once by the subsampling, bounds the random keys and sort buffers
+SUBSAMPLE_CHUNK_VALUES = 2 ** 24
+
+def get_subsample_positions(offsets: np.ndarray, sample_size: int, seed: int = 42,
+                            donor: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Draws sample_size value positions without replacement from every pair of a ragged store.
+        Pairs with at most sample_size values keep all of them in their order, like random.sample only applied
+        to the larger pairs. With donor (the donor of every value) each donor gets a share of the subsample
+        proportional to its number of values in the pair.
+        Returns the (pairs x sample_size) positions into the values, padded with -1, and the subsample sizes.
+    """
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    sizes = np.minimum(counts, sample_size)
+    positions = np.full((len(counts), sample_size), -1, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+
+    # Chunks of whole pairs, the random keys are drawn in value order so the result does not depend on the chunking
+    start = 0
+    while start < len(counts):
+        stop = max(int(np.searchsorted(offsets, offsets[start] + SUBSAMPLE_CHUNK_VALUES, side="right")) - 1, start + 1)
+        stop = min(stop, len(counts))
+        chunk_counts = counts[start:stop]
+        chunk_starts = offsets[start:stop] - offsets[start]
+        pair = np.repeat(np.arange(stop - start), chunk_counts)
+        rank = np.arange(len(pair)) - chunk_starts[pair]
+        keys = rng.random(len(pair))
+
+        if donor is not None:
+            # Spread the values of every donor evenly over the random order of the pair: the r-th of g values
+            # of a donor gets the key (r + 0.5) / g, so the first sample_size keys hold each donor proportionally
+            chunk_donor = np.asarray(donor[offsets[start]:offsets[stop]])
+            order = np.lexsort((keys, chunk_donor, pair))
+            is_first = np.ones(len(order), dtype=bool)
+            is_first[1:] = (pair[order][1:] != pair[order][:-1]) | (chunk_donor[order][1:] != chunk_donor[order][:-1])
+            group = np.cumsum(is_first) - 1
+            group_starts = np.flatnonzero(is_first)
+            group_sizes = np.diff(np.append(group_starts, len(order)))
+            spread = np.empty(len(order))
+            spread[order] = (np.arange(len(order)) - group_starts[group] + 0.5) / group_sizes[group]
+            keys = spread + keys * 1e-9
+
+        # Pairs that are not subsampled keep their order
+        keys = np.where(chunk_counts[pair] > sample_size, keys, rank)
+        order = np.lexsort((keys, pair))
+        kept = rank < sample_size
+        positions[start + pair[kept], rank[kept]] = offsets[start] + order[kept]
+        start = stop
+
+    return positions, sizes
+
+def get_subsample_matrix(store: GroupedExpressions, sample_size: int, seed: int = 42,
+                         stratify_by_donor: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Get a reproducible random subsample of sample_size Samples of every pair in a grouped expressions store
+        as a (pairs x sample_size) matrix, padded with NaN for pairs with fewer Samples, and the subsample sizes.
+        The first n columns are themselves a random subsample of size n, so one matrix serves all smaller sizes.
+    """
+    if stratify_by_donor and store.donor is None:
+        raise ValueError("Stratifying by donor needs a store with the donor of every value")
+    positions, sizes = get_subsample_positions(store.offsets, sample_size, seed,
+                                               donor=store.donor if stratify_by_donor else None)
+    matrix = np.full(positions.shape, np.nan)
+    padded = positions < 0
+    matrix[~padded] = np.asarray(store.values)[positions[~padded]]
+    return matrix, sizes
+
+def subsample_df(df: pd.DataFrame, sample_size: int, seed: int = 42) -> pd.DataFrame:
+    """
+        Caps the Samples of every Brain Region-Gene Id pair of a df to a reproducible random subsample of sample_size,
+        updating sample_count if present
+    """
+    store = grouped_expressions_from_df(df, dtype=np.float64)
+    positions, sizes = get_subsample_positions(store.offsets, sample_size, seed)
+    values = np.asarray(store.values)
+    df = df.copy()
+    df["gene_expression_values"] = [values[row[:size]].tolist() for row, size in zip(positions, sizes)]
+    if "sample_count" in df.columns:
+        df["sample_count"] = sizes
+    return df
+
 
 # Getting the BR-Region IDs pairs with different sample sizes
-def get_br_ge_count_above_sample_size(df:pd.DataFrame, range: List[int]) -> List[int]:
+def get_br_ge_count_above_sample_size(df:pd.DataFrame, range: List[int],
+                                      index: Optional[SampleCountIndex] = None) -> List[int]:
     """
-        Get the count of a Brain Region pair with a samples more than certain thresholds
+        Get the count of a Brain Region pair with a samples more than certain thresholds, using the count index if given
     """
-    count_per_sample_size = []
-    for threshold in range:  # Thresholds from 10 to 100 in steps of 10
-        count_per_sample_size.append( df[df["sample_count"] >= threshold].shape[0])
-    
-    return count_per_sample_size
+    index = index or SampleCountIndex.from_df(df)
+    return index.count_at_least(range).tolist()
@@ -0,0 +1,85 @@
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Bump to invalidate every cached stage, e.g. after changing the processed formats
+CACHE_FORMAT_VERSION = 1
+
+
+def hash_file(path: Path, content_digest: bool = False) -> str:
+    """
+        Fingerprints a file by its size and modification time, or by a sha256 digest of its content
+    """
+    if not content_digest:
+        stat = path.stat()
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_path(path: Path, content_digest: bool = False) -> str:
+    """
+        Fingerprints a file, or every file of a directory, missing paths hash to "missing"
+    """
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.is_file())
+        return hashlib.sha256("".join(f"{p.relative_to(path)}:{hash_file(p, content_digest)};"
+                                      for p in files).encode()).hexdigest()
+    if path.is_file():
+        return hash_file(path, content_digest)
+    return "missing"
+
+
+class StageCache:
+    """
+        Manifests of completed pipeline stages, keyed by their inputs, config entries and code.
+    """
+    def __init__(self, cache_dir: Path, enabled: bool = True, content_digest: bool = False):
+        self.cache_dir = Path(cache_dir)
+        self.enabled = enabled
+        self.content_digest = content_digest
+
+    def key(self, inputs: List[Path], config: Optional[Dict] = None, code: Optional[List[Path]] = None) -> str:
+        """
+            Computes the key of a stage run; code files are always hashed by content
+        """
+        fingerprint = {
+            "version": CACHE_FORMAT_VERSION,
+            "inputs": {str(p): hash_path(Path(p), self.content_digest) for p in inputs},
+            "config": config or {},
+            "code": {Path(p).name: hash_file(Path(p), content_digest=True) for p in code or []},
+        }
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _manifest_path(self, stage: str) -> Path:
+        return self.cache_dir / f"{stage.replace('/', '__')}.json"
+
+    def is_valid(self, stage: str, key: str) -> bool:
+        """
+            Whether the stage already ran with this key and its outputs are unchanged since
+        """
+        manifest_path = self._manifest_path(stage)
+        if not self.enabled or not manifest_path.exists():
+            return False
+        with manifest_path.open("r") as f:
+            manifest = json.load(f)
+        if manifest.get("key") != key:
+            return False
+        return all(hash_path(Path(p), self.content_digest) == fingerprint
+                   for p, fingerprint in manifest.get("outputs", {}).items())
+
+    def record(self, stage: str, key: str, outputs: List[Path]) -> None:
+        """
+            Records a completed stage run and the fingerprints of its outputs
+        """
+        if not self.enabled:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        manifest = {"key": key, "outputs": {str(p): hash_path(Path(p), self.content_digest) for p in outputs}}
+        with self._manifest_path(stage).open("w") as f:
+            json.dump(manifest, f, indent=4)
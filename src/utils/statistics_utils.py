@@ -1,30 +1,20 @@
-import logging
-import ijson
 import numpy as np
 from decimal import Decimal
 from pathlib import Path
-from typing import List, Tuple
-from scipy.stats import t
-from statsmodels.stats.power import TTestPower
+from typing import List, Optional, Tuple, Union
+from functools import lru_cache
 
 from src.utils.data import *
-from src.utils.plots import *
 from src.utils.memory_management import *
-from src.configs.config_parser import PathConfigParser, data_config_file
+from src.utils.instrumentation import instrumented
+from src.utils.logger import get_logger
+from src.configs.config_parser import get_config
 
 # Configs Directory
-parser = PathConfigParser(str(data_config_file))
-parser.load()
+parser = get_config()
 
 # Set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-# Create a console handler
-sh = logging.StreamHandler()
-sh.setLevel(logging.INFO)
-# Add the handler to the logger
-logger.addHandler(sh)
+logger = get_logger(__name__)
 
 
 PROCESSED_DATA_PATH = parser.get("data_paths", {}).get("processed_data")
@@ -82,20 +72,89 @@ def calculate_br_mean_expression_values(df: pd.DataFrame) -> pd.DataFrame:
     # Return the result
     return grouped
 
+# Number of values converted to float64 at once by the moments engine
+MOMENTS_CHUNK_VALUES = 2 ** 24
+
+
+# Count, mean and sum of squared deviations (M2) of every Brain Region-Gene Id pair in one scan
+def calculate_pair_moments(store: GroupedExpressions) -> pd.DataFrame:
+    """
+        Get the count, mean and M2 of every pair of a grouped expressions store without copying its values
+    """
+    offsets = np.asarray(store.offsets)
+    counts = np.diff(offsets)
+    means = np.full(len(counts), np.nan)
+    m2s = np.zeros(len(counts))
+
+    # Chunks of whole pairs bound the float64 working copy of the values
+    start = 0
+    while start < len(counts):
+        stop = max(int(np.searchsorted(offsets, offsets[start] + MOMENTS_CHUNK_VALUES, side="right")) - 1, start + 1)
+        stop = min(stop, len(counts))
+        chunk_offsets = offsets[start:stop + 1] - offsets[start]
+        chunk_counts = counts[start:stop]
+        chunk = np.asarray(store.values[offsets[start]:offsets[stop]], dtype=float)
+
+        # Segment sums from a cumulative sum, robust to pairs without values
+        prefix_sum = np.concatenate([[0.0], np.cumsum(chunk)])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            chunk_means = (prefix_sum[chunk_offsets[1:]] - prefix_sum[chunk_offsets[:-1]]) / chunk_counts
+        deviations = np.concatenate([[0.0], np.cumsum((chunk - np.repeat(chunk_means, chunk_counts)) ** 2)])
+        means[start:stop] = chunk_means
+        m2s[start:stop] = deviations[chunk_offsets[1:]] - deviations[chunk_offsets[:-1]]
+        start = stop
+
+    return pd.DataFrame({"brain_region": np.asarray(store.brain_region), "gene_id": np.asarray(store.gene_id),
+                         "count": counts, "mean": means, "m2": m2s})
+
+
+# Merge moments per key with Chan's parallel algorithm
+def merge_moments(moments: pd.DataFrame, by: str) -> pd.DataFrame:
+    """
+        Merge the count, mean and M2 of all rows sharing the same key, e.g. across pairs, chunks or donors
+    """
+    keys, inverse = np.unique(moments[by].to_numpy(), return_inverse=True)
+    counts = moments["count"].to_numpy(dtype=float)
+    means = np.nan_to_num(moments["mean"].to_numpy(dtype=float))
+
+    total_counts = np.bincount(inverse, weights=counts, minlength=len(keys))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        total_means = np.bincount(inverse, weights=counts * means, minlength=len(keys)) / total_counts
+    total_m2 = (np.bincount(inverse, weights=moments["m2"].to_numpy(dtype=float), minlength=len(keys))
+                + np.bincount(inverse, weights=counts * (means - total_means[inverse]) ** 2, minlength=len(keys)))
+
+    return pd.DataFrame({by: keys, "count": total_counts.astype(np.int64), "mean": total_means, "m2": total_m2})
+
+
+def moments_to_h0_statistics(moments: pd.DataFrame, by: str) -> pd.DataFrame:
+    """
+        Convert merged moments to the H0 columns: total_expression, total_sample_count, weighted_mean and std
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std = np.sqrt(moments["m2"] / (moments["count"] - 1))
+    return pd.DataFrame({by: moments[by],
+                         "total_expression": moments["mean"] * moments["count"],
+                         "total_sample_count": moments["count"],
+                         "weighted_mean": moments["mean"],
+                         "std": std.where(moments["count"] > 1)})
+
+
+# Calculate H0 mean, std and count per gene id or brain region in one scan
+@instrumented()
+def calculate_h0_statistics(store: GroupedExpressions, by: str = "gene_id") -> pd.DataFrame:
+    """
+        Get the H0 mean, std (ddof=1) and sample count per gene id or brain region of a grouped expressions store
+    """
+    return moments_to_h0_statistics(merge_moments(calculate_pair_moments(store), by), by)
+
+
 # Calculate the standard deviation for each gene_id without exploding the list
 def calculate_std_gene_id_optimized(df: pd.DataFrame) -> pd.DataFrame:
     """
         Get the STD of each Gene ID
     """
-    def calculate_std(gene_expression_list):
-        return pd.Series(gene_expression_list).std()
-
-    # Apply the std calculation to the gene expression values for each group of gene_id
-    def group_std(x):
-        return calculate_std([item for sublist in x for item in sublist])  # Flatten the list of lists
-    
-    # Group by gene_id and apply the function
-    std_per_gene = df.groupby('gene_id')['gene_expression_values'].apply(group_std).reset_index(name='std')
+    store = grouped_expressions_from_df(df, dtype=np.float64)
+    std_per_gene = calculate_h0_statistics(store, by="gene_id")[["gene_id", "std"]]
     
     return std_per_gene
 
@@ -143,56 +202,403 @@ def calculate_t_statistic(sample_mean: float, sample_std: float,
     return t_stat 
 
 
+# Number of resampled values held in memory at once by the bootstrap kernel
+BOOTSTRAP_CHUNK_ELEMENTS = 2 ** 24
+
+
+# Draw the resampling indices of B bootstrap samples
+def draw_bootstrap_indices(B: int, n: int, rng: np.random.Generator) -> np.ndarray:
+    """
+        Function to draw a (B, n) matrix of resampling indices, shareable by all samples of size n
+    """
+    return rng.integers(0, n, size=(B, n))
+
+
+# Calculate the t statistics of the bootstrapped samples of many samples at once
+def calculate_bootstrap_t_statistics(samples: np.ndarray, population_means: np.ndarray, indices: np.ndarray,
+                                     return_samples: bool = False) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+        Function to calculate the (pairs, B) t statistics of the samples resampled with a (B, n) index matrix.
+        The (pairs, B, n) resampled values are only returned if return_samples is set.
+    """
+    samples = np.asarray(samples, dtype=float)
+    population_means = np.asarray(population_means, dtype=float)
+    B, n = indices.shape
+    if samples.shape[1] != n:
+        raise ValueError(f"Samples of size {samples.shape[1]} do not match the index matrix of size {n}")
+
+    t_stats = np.empty((samples.shape[0], B))
+    resampled_samples = np.empty((samples.shape[0], B, n)) if return_samples else None
+
+    # Resample chunks of pairs to bound the memory of the (chunk, B, n) resampled values
+    chunk_size = max(1, BOOTSTRAP_CHUNK_ELEMENTS // (B * n))
+    for start in range(0, samples.shape[0], chunk_size):
+        stop = start + chunk_size
+        chunk = samples[start:stop]
+        # numpy reduces a (1, B, n) array in another summation order than a (pairs, B, n) one, which changes
+        # the t statistics in their last bits, so a single pair is resampled twice to keep results chunk-independent
+        x_b = np.repeat(chunk, 2, axis=0)[:, indices] if len(chunk) == 1 else chunk[:, indices]
+        t_stats[start:stop] = calculate_t_statistic(x_b.mean(axis=2)[:len(chunk)], x_b.std(axis=2)[:len(chunk)], n,
+                                                    population_means[start:stop, None])
+        if return_samples:
+            resampled_samples[start:stop] = x_b[:len(chunk)]
+
+    return t_stats, resampled_samples
+
+
+# Calculate P-values of many samples using Bootstraping
+def calculate_batch_bootstrap_p_values(samples: np.ndarray, t_statistics: np.ndarray, population_means: np.ndarray,
+                                       indices: np.ndarray) -> np.ndarray:
+    """
+        Function to calculate the p-value of each sample from B bootstraped samples sharing one index matrix
+    """
+    t_stats, _ = calculate_bootstrap_t_statistics(samples, population_means, indices)
+    return np.mean(t_stats > np.asarray(t_statistics)[:, None], axis=1, dtype=float)
+
+
 # Calculate P-value using Bootstraping
 def calculate_bootstrap_p_value(sample: List[float], t_statistic: float, B: int,
-                                population_mean: float) -> Tuple[float, List[float]]:
+                                population_mean: float, rng: Optional[np.random.Generator] = None,
+                                indices: Optional[np.ndarray] = None,
+                                return_samples: bool = False) -> Tuple[float, Optional[np.ndarray]]:
     """
-        Function to calculate p-value from B bootstraped samples
-    """   
-    n = len(sample)
-    t = np.zeros(B)
-    boostraped_samples =[]
-    
-    # Resample the data B times
-    np.random.seed(42)
-    for b in range(B):
-        x_b = np.random.choice(sample, n, replace=True)
-        boostraped_samples.extend(x_b)
-        t[b] = calculate_t_statistic(np.mean(x_b), np.std(x_b), len(x_b), population_mean)
+        Function to calculate p-value from B bootstraped samples.
+        The bootstraped samples are only returned (flattened) if return_samples is set.
+    """
+    sample = np.asarray(sample, dtype=float)
+
+    # Resample the data B times, seeded for reproducibility unless a generator or indices are given
+    if indices is None:
+        rng = np.random.default_rng(42) if rng is None else rng
+        indices = draw_bootstrap_indices(B, len(sample), rng)
+    t_stats, boostraped_samples = calculate_bootstrap_t_statistics(sample[None, :], np.array([population_mean]),
+                                                                   indices, return_samples=return_samples)
 
     # Compute the p-value
-    p_value = np.mean(t > t_statistic, dtype=float)
-    
-    return p_value, boostraped_samples
+    p_value = np.mean(t_stats[0] > t_statistic, dtype=float)
+
+    return p_value, boostraped_samples[0].ravel() if return_samples else None
  
  
- # Calculate the test Power
+# Resamples drawn per round by the sequential bootstrap and confidence of its stopping bound
+SEQUENTIAL_BOOTSTRAP_BATCH = 100
+SEQUENTIAL_BOOTSTRAP_CONFIDENCE = 0.999
+
+
+# Confidence bounds of bootstrap p-values
+def calculate_p_value_bounds(exceedances: np.ndarray, resamples: np.ndarray,
+                             confidence: float = SEQUENTIAL_BOOTSTRAP_CONFIDENCE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Function to calculate the two-sided Wilson score interval of p-values estimated from exceedances out of resamples
+    """
+    from scipy.stats import norm
+
+    z = norm.ppf(0.5 + confidence / 2)
+    resamples = np.asarray(resamples, dtype=float)
+    p_value = np.asarray(exceedances, dtype=float) / resamples
+    denominator = 1 + z ** 2 / resamples
+    center = (p_value + z ** 2 / (2 * resamples)) / denominator
+    half_width = z * np.sqrt(p_value * (1 - p_value) / resamples + z ** 2 / (4 * resamples ** 2)) / denominator
+    return center - half_width, center + half_width
+
+
+# Calculate P-values of many samples using Bootstraping, stopping each sample once its decision is clear
+def calculate_sequential_bootstrap_p_values(samples: np.ndarray, t_statistics: np.ndarray, population_means: np.ndarray,
+                                            B: int, rng: np.random.Generator, alpha: float = 0.05,
+                                            batch_size: int = SEQUENTIAL_BOOTSTRAP_BATCH,
+                                            confidence: float = SEQUENTIAL_BOOTSTRAP_CONFIDENCE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Function to calculate the p-value of each sample from at most B bootstraped samples, drawn in batches.
+        A sample stops once the confidence interval of its p-value excludes alpha.
+        The batches are drawn in order from rng, so a sample running all B resamples gets the p-value of
+        calculate_batch_bootstrap_p_values with draw_bootstrap_indices(B, n, rng), and an early stop uses a prefix of them.
+        Returns the p-values and the number of resamples used by each sample.
+    """
+    samples = np.asarray(samples, dtype=float)
+    t_statistics = np.asarray(t_statistics, dtype=float)
+    population_means = np.asarray(population_means, dtype=float)
+    exceedances = np.zeros(len(samples))
+    resamples = np.zeros(len(samples), dtype=np.int64)
+    active = np.arange(len(samples))
+
+    for start in range(0, B, batch_size):
+        # Every sample has stopped, the remaining batches would not be used
+        if not len(active):
+            break
+        indices = draw_bootstrap_indices(min(batch_size, B - start), samples.shape[1], rng)
+        t_stats, _ = calculate_bootstrap_t_statistics(samples[active], population_means[active], indices)
+        exceedances[active] += np.sum(t_stats > t_statistics[active, None], axis=1)
+        resamples[active] += len(indices)
+
+        # Keep the samples whose interval still contains alpha
+        lower, upper = calculate_p_value_bounds(exceedances[active], resamples[active], confidence)
+        active = active[(lower <= alpha) & (upper >= alpha)]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return exceedances / resamples, resamples
+
+
+# Calculate P-value using Bootstraping, stopping once the decision is clear
+def calculate_sequential_bootstrap_p_value(sample: List[float], t_statistic: float, B: int, population_mean: float,
+                                           alpha: float = 0.05, rng: Optional[np.random.Generator] = None,
+                                           batch_size: int = SEQUENTIAL_BOOTSTRAP_BATCH) -> Tuple[float, int]:
+    """
+        Function to calculate p-value from at most B bootstraped samples and the number of resamples used
+    """
+    rng = np.random.default_rng(42) if rng is None else rng
+    p_values, resamples = calculate_sequential_bootstrap_p_values(np.asarray(sample, dtype=float)[None, :], [t_statistic],
+                                                                  [population_mean], B, rng, alpha, batch_size)
+    return float(p_values[0]), int(resamples[0])
+
+
+# Calculate the Wilcoxon signed-rank test of many samples at once
+def calculate_batch_wilcoxon(differences: np.ndarray, alternative: str = "greater") -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Function to calculate the Wilcoxon W statistic and p-value of every row of differences, as wilcoxon per row.
+        scipy picks one method (exact or normal approximation) for a whole 2-D call, so rows with ties or zero
+        differences (which get the approximation) are tested apart from the other rows.
+    """
+    from scipy.stats import wilcoxon
+
+    differences = np.asarray(differences, dtype=float)
+    sorted_abs = np.sort(np.abs(differences), axis=1)
+    tied = (sorted_abs[:, 0] == 0) | (np.diff(sorted_abs, axis=1) == 0).any(axis=1)
+
+    statistic, p_value = np.full(len(differences), np.nan), np.full(len(differences), np.nan)
+    for rows in (~tied, tied):
+        if rows.any():
+            result = wilcoxon(differences[rows], alternative=alternative, axis=1)
+            statistic[rows], p_value[rows] = result.statistic, result.pvalue
+    return statistic, p_value
+
+
+# Effect size grid of the power lookup tables as (start, stop, number of points)
+POWER_TABLE_GRID = (-3.0, 3.0, 6001)
+
+
+# Calculate the power of one-sample or two-sample t tests for arrays of effect sizes and sample sizes
+def calculate_power(effect_size: np.ndarray, sample_size: np.ndarray, alpha: float = 0.05,
+                    alternative: str = "larger", test: str = "one-sample") -> np.ndarray:
+    """
+        Function to calculate the power of a t test from the noncentral t distribution.
+        test is "one-sample" (as TTestPower) or "independent" (as TTestIndPower with equal group sizes).
+    """
+    from scipy.stats import nct, t
+
+    effect_size, sample_size = np.broadcast_arrays(np.asarray(effect_size, dtype=float),
+                                                   np.asarray(sample_size, dtype=float))
+    if test == "one-sample":
+        df = sample_size - 1
+        nc = effect_size * np.sqrt(sample_size)
+    elif test == "independent":
+        df = 2 * sample_size - 2
+        nc = effect_size * np.sqrt(sample_size / 2)
+    else:
+        raise ValueError(f"Unsupported test: {test}")
+
+    if alternative == "larger":
+        power = nct.sf(t.isf(alpha, df), df, nc)
+    elif alternative == "smaller":
+        power = nct.cdf(t.ppf(alpha, df), df, nc)
+    elif alternative == "two-sided":
+        critical_value = t.isf(alpha / 2, df)
+        power = nct.sf(critical_value, df, nc) + nct.cdf(-critical_value, df, nc)
+    else:
+        raise ValueError(f"Unsupported alternative: {alternative}")
+
+    return power
+
+
+# Power lookup table per (sample size, alpha, alternative, test), built once per process
+@lru_cache(maxsize=None)
+def get_power_table(sample_size: int, alpha: float = 0.05, alternative: str = "larger",
+                    test: str = "one-sample", grid: Tuple[float, float, int] = POWER_TABLE_GRID) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Function to get the effect size grid and its power for one test setting
+    """
+    effect_size_grid = np.linspace(*grid)
+    power_grid = calculate_power(effect_size_grid, sample_size, alpha=alpha, alternative=alternative, test=test)
+    effect_size_grid.flags.writeable = False
+    power_grid.flags.writeable = False
+    return effect_size_grid, power_grid
+
+
+def interpolate_power(effect_size: np.ndarray, sample_size: int, alpha: float = 0.05, alternative: str = "larger",
+                      test: str = "one-sample", grid: Tuple[float, float, int] = POWER_TABLE_GRID) -> np.ndarray:
+    """
+        Function to interpolate the power from the lookup table, effect sizes off the grid are calculated exactly
+    """
+    effect_size = np.asarray(effect_size, dtype=float)
+    effect_size_grid, power_grid = get_power_table(int(sample_size), alpha, alternative, test, grid)
+    power = np.interp(effect_size, effect_size_grid, power_grid)
+
+    off_grid = (effect_size < effect_size_grid[0]) | (effect_size > effect_size_grid[-1])
+    if np.any(off_grid):
+        power = np.where(off_grid, calculate_power(effect_size, sample_size, alpha, alternative, test), power)
+    return power
+
+
+# Calculate the test Power
 def calculate_test_power(effect_size: float, sample_mean: float, population_mean: float, 
                           sample_std: float, sample_size: int, alpha: float = 0.05) ->  float:
     """
         Function to calculate power for a test
     """   
-    # Initialize TTestPower object
-    power_analysis = TTestPower()
-
     # Calculate power
-    power = power_analysis.solve_power(effect_size=effect_size, nobs=sample_size, alpha=alpha, alternative='larger')
+    power = calculate_power(effect_size, sample_size, alpha=alpha, alternative='larger', test="one-sample")
     
-    return power
+    return float(power)
 
 
-from statsmodels.stats.power import TTestPower, TTestIndPower
 # Calculate the test Power
 def calculate_Indtest_power(effect_size: float, sample_mean: float, population_mean: float, 
                           sample_std: float, sample_size: int, alpha: float = 0.05) ->  float:
     """
         Function to calculate power for a test
     """   
-    # Initialize TTestPower object
-    # power_analysis = TTestPower()
-    power_analysis = TTestIndPower()
-
     # Calculate power
-    power = power_analysis.power(effect_size=effect_size, nobs1=sample_size, alpha=alpha, alternative='larger')
+    power = calculate_power(effect_size, sample_size, alpha=alpha, alternative='larger', test="independent")
     
-    return power
+    return float(power)
+
+
+
+# Index of the H0 statistics per gene id, built once for repeated and bulk lookups
+class GeneH0Index:
+    """
+        Sorted-key index over the H0 mean, std and sample count of every gene id
+    """
+    def __init__(self, geneid_H0: pd.DataFrame):
+        gene_ids = geneid_H0["gene_id"].to_numpy(dtype=np.int64)
+        order = np.argsort(gene_ids, kind="stable")
+        self.gene_ids = gene_ids[order]
+        self.mean = geneid_H0["weighted_mean"].to_numpy(dtype=float)[order]
+        self.std = geneid_H0["std"].to_numpy(dtype=float)[order]
+        self.count = geneid_H0["total_sample_count"].to_numpy()[order]
+
+    def positions(self, gene_ids: np.ndarray) -> np.ndarray:
+        """
+            Positions of the gene ids in the index, raising a KeyError for unknown gene ids
+        """
+        gene_ids = np.atleast_1d(np.asarray(gene_ids, dtype=np.int64))
+        positions = np.searchsorted(self.gene_ids, gene_ids).clip(max=max(len(self.gene_ids) - 1, 0))
+        missing = (self.gene_ids[positions] != gene_ids) if len(self.gene_ids) else np.ones(len(gene_ids), dtype=bool)
+        if missing.any():
+            raise KeyError(f"No H0 statistics for gene ids: {gene_ids[missing][:10].tolist()}")
+        return positions
+
+    def lookup(self, gene_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+            H0 mean, std and sample count of every gene id
+        """
+        positions = self.positions(gene_ids)
+        return self.mean[positions], self.std[positions], self.count[positions]
+
+    def get(self, gene_id: int) -> Tuple[float, float, int]:
+        """
+            H0 mean, std and sample count of a single gene id
+        """
+        position = self.positions(gene_id)[0]
+        return self.mean[position], self.std[position], self.count[position]
+
+
+# Calculate the statistics of the sample size sweep for a batch of Brain Region-Gene Id pairs
+def get_h0_statistics(geneid_H0: Union[pd.DataFrame, GeneH0Index], gene_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        Function to align the H0 mean, std and sample count of each gene with the gene ids given.
+        geneid_H0 may be the H0 df or a GeneH0Index built from it.
+    """
+    if not isinstance(geneid_H0, GeneH0Index):
+        geneid_H0 = GeneH0Index(geneid_H0)
+    return geneid_H0.lookup(gene_ids)
+
+
+@instrumented()
+def calculate_batch_statistics(samples: np.ndarray, brain_regions: np.ndarray, gene_ids: np.ndarray,
+                               geneid_H0: Union[pd.DataFrame, GeneH0Index], sample_sizes: List[int], alpha: float = 0.05,
+                               p_value_method: str = "wilcoxon", B: int = 1000, seed: int = 42,
+                               power_table: bool = False) -> pd.DataFrame:
+    """
+        Function to calculate the effect size, p-value, power and test statistic of every pair for every sample size.
+        Row i of samples holds the values of pair i, the first sample_size values are used per sample size.
+        geneid_H0 is the H0 df or a GeneH0Index built from it.
+        p_value_method is either "wilcoxon", "bootstrap" (B resamples, one index matrix per sample size) or
+        "sequential_bootstrap" (at most B resamples, stopping each pair once its decision at alpha is clear,
+        the resamples used are reported in the B_used_<sample_size> columns).
+        The t_stat_<sample_size> columns hold the Wilcoxon W statistic with "wilcoxon" (as the notebooks) and the
+        Student t statistic with the bootstrap methods.
+        power_table interpolates the power from the cached lookup table instead of calculating it exactly.
+    """
+    if p_value_method not in ("wilcoxon", "bootstrap", "sequential_bootstrap"):
+        raise ValueError(f"Unsupported p-value method: {p_value_method}")
+    samples = np.asarray(samples, dtype=float)
+    if samples.ndim != 2:
+        raise ValueError(f"Expected a 2-D (pairs x sample_size) array, got {samples.ndim}-D")
+    if max(sample_sizes) > samples.shape[1]:
+        raise ValueError(f"Sample size {max(sample_sizes)} larger than the available samples: {samples.shape[1]}")
+    if min(sample_sizes) < 2:
+        raise ValueError("Sample sizes must be at least 2")
+
+    # Getting Control Group stats for every pair
+    control_group_mean, control_group_std, control_group_size = get_h0_statistics(geneid_H0, gene_ids)
+
+    # Prefix sums of the centered values give the mean and std of every sample size in one pass
+    centered = samples - control_group_mean[:, None]
+    prefix_sum = np.cumsum(centered, axis=1)
+    prefix_sum_sq = np.cumsum(centered ** 2, axis=1)
+
+    stats = {"brain_region": np.asarray(brain_regions), "gene_id": np.asarray(gene_ids)}
+    for sample_size in sample_sizes:
+        # Calculating Sample Stats
+        centered_mean = prefix_sum[:, sample_size - 1] / sample_size
+        sample_mean = centered_mean + control_group_mean
+        sample_var = np.maximum(prefix_sum_sq[:, sample_size - 1] / sample_size - centered_mean ** 2, 0.0)
+        sample_std = np.sqrt(sample_var)
+
+        # (1) Calculating Effect Size.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            effect_size = calculate_cohen_d(sample_mean=sample_mean, control_group_mean=control_group_mean,
+                                            sample_std=sample_std, control_group_std=control_group_std,
+                                            sample_length=sample_size, control_group_length=control_group_size)
+
+        # (2) Calculating Power
+        if power_table:
+            power = interpolate_power(effect_size, sample_size, alpha=alpha, alternative="larger")
+        else:
+            power = calculate_power(effect_size, sample_size, alpha=alpha, alternative="larger")
+
+        # (3) Calculating the t statistic and the p_value of the sample
+        t_stat = calculate_t_statistic(sample_mean, sample_std, sample_size, control_group_mean)
+        # The index matrices only depend on the seed and sample size, so any subset of pairs gets the same draws
+        rng = np.random.default_rng([seed, sample_size])
+        if p_value_method == "wilcoxon":
+            # The notebooks store the Wilcoxon W statistic as the t_stat of a sample
+            t_stat, p_value = calculate_batch_wilcoxon(centered[:, :sample_size], alternative="greater")
+        elif p_value_method == "bootstrap":
+            indices = draw_bootstrap_indices(B, sample_size, rng)
+            p_value = calculate_batch_bootstrap_p_values(samples[:, :sample_size], t_stat, control_group_mean, indices)
+        else:
+            p_value, B_used = calculate_sequential_bootstrap_p_values(samples[:, :sample_size], t_stat,
+                                                                      control_group_mean, B, rng, alpha=alpha)
+
+        stats[f"effect_size_{sample_size}"] = effect_size
+        stats[f"p-value_{sample_size}"] = p_value
+        stats[f"power_{sample_size}"] = power
+        stats[f"t_stat_{sample_size}"] = t_stat
+        if p_value_method == "sequential_bootstrap":
+            stats[f"B_used_{sample_size}"] = B_used
+
+    return pd.DataFrame(stats)
+
+
+
+# Writing the statistics of every sample size into separate files
+def write_stats_per_sample_size(stats_df: pd.DataFrame, sample_sizes: List[int], output_path: Path) -> None:
+    """
+        Function to write the <sample_size>_stats.csv files out of the sweep statistics
+    """
+    for sample_size in sample_sizes:
+        columns = {f"{stat}_{sample_size}": stat for stat in ["effect_size", "p-value", "power", "t_stat", "B_used"]
+                   if f"{stat}_{sample_size}" in stats_df.columns}
+        sample_size_stats = stats_df[["brain_region", "gene_id", *columns]].rename(columns=columns)
+        write_df_to_csv(sample_size_stats, output_path / Path(f"{sample_size}_stats.csv"))